@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
 # System modules
-import json
+import importlib
 import os
 import re
 import shutil
 import sys
+import time
+
+# Start of invocation, for import time report
+__started__ = time.time()
 
 # Kodi modules
 import xbmc
@@ -39,19 +43,52 @@ else:
     __unrar__ = xbmc.translatePath(os.path.join(__profile__, 'unrar')).decode("utf-8")
     __temp__ = xbmc.translatePath(os.path.join(__profile__, 'temp')).decode("utf-8")
 
-sys.path.append(__resource__)
+sys.path.insert(0, __resource__)
 
-# Addon modules
-from prevodi import PrevodException, Prevodi
+# Addon modules; site client and archive handling are
+# imported on demand, see ActionHandler.prev and fetcher
+from preerrors import PrevodException, PrevodLoginException, PrevodTimeoutException, PrevodUnavailableException
+from prefetcher import Fetcher
+from preindex import CacheEviction, CacheIndex
 from prelogging import Prelogger
-import prearchive as     pa
 import preutils   as     pu
+import preworker
+
+__imported__ = time.time()
+
+# Modules that cache hits should not need,
+# import report lists those that got imported
+HEAVY_MODULES = ('requests', 'prevodi', 'prearchive', 'rarfile')
 
 
 # Action handler
 class ActionHandler(object):
     SETTINGS_USERNAME = 'prevodi-username'
     SETTINGS_PASSWORD = 'prevodi-password'
+    SETTINGS_SEARCH_TTL = 'search-cache-ttl'
+    SETTINGS_NEGATIVE_CACHE = 'negative-cache'
+    SETTINGS_NEGATIVE_TTL = 'negative-cache-ttl'
+    SETTINGS_LISTING_FRESHNESS = 'listing-freshness'
+    SETTINGS_SEARCH_DEADLINE = 'search-deadline'
+    SETTINGS_DOWNLOAD_DEADLINE = 'download-deadline'
+    SETTINGS_RETRY_ATTEMPTS = 'retry-attempts'
+    SETTINGS_MAX_ARCHIVE_SIZE = 'max-archive-size'
+    SETTINGS_WORKER = 'worker'
+    SETTINGS_CACHE_SIZE = 'cache-size'
+    SETTINGS_CACHE_ENTRIES = 'cache-entries'
+    SETTINGS_LISTING_TTL = 'listing-ttl'
+    SETTINGS_SEASONS_TTL = 'seasons-ttl'
+    SETTINGS_SUBTITLE_TTL = 'subtitle-ttl'
+    # Manual search format, e.g. "The Wire S01E01"
+    REGEX_MANUAL_SEARCH = r'^\s*(.+?)\s+S(\d+)E(\d+)\s*$'
+    # Import time budgets in seconds, for actions answered
+    # from cache and for actions that had to reach the site
+    IMPORT_BUDGET_CACHED = 0.05
+    IMPORT_BUDGET_ONLINE = 0.5
+    # Seconds waited for worker beyond time budget of action
+    WORKER_TIMEOUT_MARGIN = 5
+    # Seconds spent on cache eviction after action is answered
+    EVICTION_BUDGET = 0.1
 
     def __init__(self, raw_params):
         self.log = Prelogger()
@@ -60,7 +97,18 @@ class ActionHandler(object):
         self.script_name = __addonname__
         self.params = pu.get_params(sys.argv[2])
         self.action = self.params['?action'][0]
-        self.prev = Prevodi(self.username, self.password)
+        # Whole action, not single request, has to fit into time budget
+        if self.action == 'download':
+            self.time_budget = self.get_int_setting(self.SETTINGS_DOWNLOAD_DEADLINE, 30)
+        else:
+            self.time_budget = self.get_int_setting(self.SETTINGS_SEARCH_DEADLINE, 15)
+        # Budget runs from here, download restarts it once user confirms
+        self.action_started = __started__
+        # Created on first use, see prev and fetcher
+        self._prev = None
+        self._fetcher = None
+        # Modules imported on demand, with time spent
+        self.import_times = list()
         self.resume = raw_params[2][7:].lower() == 'true'
         self.handle = int(raw_params[1])
         if xbmcvfs.exists(__temp__):
@@ -76,9 +124,91 @@ class ActionHandler(object):
         self.log.debug("Action handler invoked with: {0}".format(raw_params[2]))
         self.log.debug("Parameters: {0}, resume: {1}, handle: {2}".format(
             self.params, self.resume, self.handle))
-        # Remove old directories
-        dirs = pu.remove_older_than(__cache__, 3)
-        self.log.debug("Removed items older than 3 days: {0}".format(dirs))
+        self.index = CacheIndex(os.path.join(__profile__, CacheIndex.INDEX_FILE))
+
+    # Site client, created on first use: actions
+    # answered from cache do not import network stack
+    @property
+    def prev(self):
+        if self._prev is None:
+            prevodi = self.import_module('prevodi')
+            self._prev = prevodi.PipelinedPrevodi(self.username, self.password, __profile__)
+            self._prev.log = self.log
+            self._prev.search_cache.ttl = self.get_int_setting(self.SETTINGS_SEARCH_TTL, 24) * 60 * 60
+            self._prev.seasons_cache.ttl = self.get_int_setting(self.SETTINGS_SEASONS_TTL, 30) * 24 * 60 * 60
+            self._prev.retry_attempts = max(1, self.get_int_setting(self.SETTINGS_RETRY_ATTEMPTS, 3))
+            self._prev.max_archive_size = self.get_int_setting(self.SETTINGS_MAX_ARCHIVE_SIZE, 5120) * 1024
+            self._prev.deadline = prevodi.Deadline(self.get_remaining_time())
+        return self._prev
+
+    # Fetcher of listings and subtitles from site,
+    # cached ones are looked up in cache index
+    @property
+    def fetcher(self):
+        if self._fetcher is None:
+            self._fetcher = Fetcher(
+                self.prev,
+                __profile__,
+                self.get_int_setting(self.SETTINGS_NEGATIVE_TTL, 6) * 60 * 60)
+            self._fetcher.log = self.log
+            self._fetcher.res_data = __resdata__
+            self._fetcher.unrar_dir = __unrar__
+            self._fetcher.temp_dir = __temp__
+            self._fetcher.dialog = __progress__
+            self._fetcher.str_get_unrar = get_local_str(32023)
+        return self._fetcher
+
+    # Removes least recently used items that are too old or
+    # do not fit into cache limits, a little at a time; called
+    # after action is answered, so that it does not delay dialog
+    def evict_cache(self):
+        eviction = CacheEviction(self.index, __cache__, os.path.join(__profile__, CacheEviction.MARKER_FILE))
+        if not eviction.is_due():
+            return
+        eviction.listing_ttl = self.get_int_setting(self.SETTINGS_LISTING_TTL, 3) * 24 * 60 * 60
+        eviction.subtitle_ttl = self.get_int_setting(self.SETTINGS_SUBTITLE_TTL, 14) * 24 * 60 * 60
+        eviction.max_entries = self.get_int_setting(self.SETTINGS_CACHE_ENTRIES, 1000)
+        eviction.max_size = self.get_int_setting(self.SETTINGS_CACHE_SIZE, 50) * 1024 * 1024
+        items = eviction.run(self.EVICTION_BUDGET)
+        self.log.debug("Removed items from cache: {0}".format(items))
+
+    # Return:
+    #   Seconds left of action's time budget
+    def get_remaining_time(self):
+        return self.time_budget - (time.time() - self.action_started)
+
+    # Imports module on demand, time spent
+    # is added to import report
+    def import_module(self, name):
+        start = time.time()
+        module = importlib.import_module(name)
+        self.import_times.append((name, time.time() - start,))
+        return module
+
+    # Logs time spent importing modules, so that action
+    # can be checked against its import budget
+    def report_imports(self):
+        startup = __imported__ - __started__
+        total = startup + sum(seconds for _, seconds in self.import_times)
+        budget = self.IMPORT_BUDGET_CACHED if self._prev is None else self.IMPORT_BUDGET_ONLINE
+        message = "Import time of action '{0}': {1} ms (startup {2} ms, on demand: {3}), heavy modules: {4}".format(
+            self.action,
+            int(total * 1000),
+            int(startup * 1000),
+            ", ".join("{0} {1} ms".format(name, int(seconds * 1000)) for name, seconds in self.import_times) or "none",
+            [name for name in HEAVY_MODULES if name in sys.modules])
+        if total > budget:
+            self.log.notice("{0} - over budget of {1} ms".format(message, int(budget * 1000)))
+        else:
+            self.log.debug(message)
+
+    # Returns numeric setting, or default if not set
+    @staticmethod
+    def get_int_setting(setting_id, default):
+        try:
+            return int(__addon__.getSetting(setting_id))
+        except ValueError:
+            return default
 
     def show_notification(self, message):
         xbmc.executebuiltin(u'Notification({0}, {1})'.format(self.script_name, message).encode("utf-8"))
@@ -92,73 +222,128 @@ class ActionHandler(object):
         if self.action not in ('search', 'manualsearch', 'download'):
             self.show_notification(get_local_str(2103))
             return False
-        # Check if username and password are valid
-        try:
-            self.prev.login()
-        except PrevodException:
-            ok = __dialog__.ok(self.script_name, get_local_str(32012))
-            __addon__.openSettings()
-            return False
         return True
 
-    # Simply dispatch the action
+    # Simply dispatch the action, login happens
+    # only when action needs authenticated resource
     def do(self):
         if not self.params_are_valid():
             return
-        self.ACTION_MAP[self.action]()
+        try:
+            self.ACTION_MAP[self.action]()
+        except PrevodLoginException as e:
+            self.log.error(e)
+            ok = __dialog__.ok(self.script_name, get_local_str(32012))
+            __addon__.openSettings()
+            return
+        except (PrevodTimeoutException, PrevodUnavailableException) as e:
+            self.log.error(e)
+            if isinstance(e, PrevodUnavailableException):
+                self.show_notification(get_local_str(32037))
+            else:
+                self.show_notification(get_local_str(32035))
+            if self.action == 'download':
+                self.add_stale_subtitle()
+            return
+        except PrevodException as e:
+            # Unexpected answer of site, or archive that cannot be read
+            self.log.error(e)
+            self.show_notification(get_local_str(32010))
+            if self.action == 'download':
+                self.add_stale_subtitle()
+            return
+        # Keep session cookies for next invocation
+        if self._prev is not None:
+            self.prev.save_session()
 
     # Search when invoking plugin while playing a show
     # or when a TV show is selected through the GUI
     def search(self):
         self.log.debug("Searching for subtitles ...")
         curr_show = self.get_current_show()
-        # Check if cached directory exists
-        if os.path.exists(curr_show['cachedir']):
-            # Load JSON file with subtitle data
-            json_file_path = os.path.join(curr_show['cachedir'], 'subtitles.json')
-            with open(json_file_path, 'r') as f:
-                subtitle_archives = json.load(f)
-            self.log.debug("Loaded data from '{0}'".format(json_file_path))
-        else:
-            # Search in prijevodi
-            self.prev.search(curr_show['tvshow_title'])
+        use_misses = __addon__.getSetting(self.SETTINGS_NEGATIVE_CACHE) != 'false'
+        subtitle_archives = self.get_subtitle_archives(curr_show, use_misses)
+        if subtitle_archives:
+            self.list_subtitles(curr_show, subtitle_archives)
+
+    # Returns subtitle archives for given show, either
+    # from cache index or from prijevodi
+    # Params:
+    #  curr_show: Show data, as returned by get_current_show()
+    #  use_misses: Skip shows and episodes recently not found, and
+    #              take search results from cache; otherwise site
+    #              is searched again
+    def get_subtitle_archives(self, curr_show, use_misses=True):
+        listing = self.index.get_listing(curr_show['cachedir'])
+        if listing is not None:
+            subtitle_archives, age = listing
+            self.log.debug("Loaded cached listing of '{0}'".format(curr_show['cachedir']))
+            self.index.access_listing(curr_show['cachedir'])
+            self.revalidate_listing(curr_show, age)
+            return subtitle_archives
+        return self.fetch_from_site(
+            'fetch_listing',
+            tvshow_title=curr_show['tvshow_title'],
+            season=curr_show['season'],
+            episode=curr_show['episode'],
+            cachedir=curr_show['cachedir'],
+            use_misses=use_misses,
+            use_search_cache=use_misses)
+
+    # Calls fetcher method in resident worker of service when
+    # worker is enabled, its session and caches are already warm;
+    # in this invocation if worker is disabled or cannot be used
+    # Params:
+    #  method: Name of Fetcher method
+    #  params: Its keyword arguments
+    def fetch_from_site(self, method, **params):
+        if __addon__.getSetting(self.SETTINGS_WORKER) == 'true':
+            remaining = self.get_remaining_time()
+            client = preworker.WorkerClient(
+                preworker.get_socket_path(__profile__),
+                max(remaining, 0) + self.WORKER_TIMEOUT_MARGIN)
             try:
-                self.prev.get_tv_show(curr_show['tvshow_title'])
-            except PrevodException as e:
-                self.log.error(e)
-                return
-            # At this moment
-            if len(self.prev.seasons.keys()) > 0:
-                self.prev.get_subtitles(curr_show['season'], curr_show['episode'])
-                if self.prev.archives:
-                    # Make subdirectory for potential subtitles
-                    os.makedirs(curr_show['cachedir'])
-                    # Save this episode's subtitle data
-                    json_file_path = os.path.join(curr_show['cachedir'], 'subtitles.json')
-                    with open(json_file_path, 'wb') as f:
-                        json.dump(self.prev.archives, f)
-                    subtitle_archives = self.prev.archives
-                    self.log.debug("Saved data to '{0}'".format(json_file_path))
-                else:
-                    return
-            else:
-                return
+                return client.call(method, budget=remaining, **params)
+            except preworker.WorkerException as e:
+                self.log.debug("Worker not used: {0}".format(e))
+        if method == 'fetch_subtitle':
+            # Only downloads need archive handling, imported
+            # here so that it shows in import report
+            self.import_module('prearchive')
+        return getattr(self.fetcher, method)(**params)
+
+    # Stale-while-revalidate: cached listing older than freshness
+    # threshold is refreshed by detached background job,
+    # so that next search sees new archives
+    # Params:
+    #  age: Age of cached listing in seconds
+    def revalidate_listing(self, curr_show, age):
+        max_age = self.get_int_setting(self.SETTINGS_LISTING_FRESHNESS, 12) * 60 * 60
+        if max_age <= 0 or age < max_age:
+            return
+        # Listing is marked fresh right away, so that
+        # searches until job finishes do not start it again
+        self.index.touch_listing(curr_show['cachedir'])
+        self.log.debug("Listing is {0} seconds old, refreshing in background".format(int(age)))
+        xbmc.executebuiltin('RunScript({0}, refresh, {1}, {2}, {3}, {4})'.format(
+            os.path.join(__cwd__, 'background.py'),
+            pu.get_quoted_str(curr_show['tvshow_title']),
+            curr_show['season'],
+            curr_show['episode'],
+            pu.get_quoted_str(curr_show['cachedir'])))
+
+    # Adds directory items for subtitles in languages chosen by user
+    def list_subtitles(self, curr_show, subtitle_archives):
         langs_map = pu.get_language_list(self.params['languages'][0])
         self.log.debug("Languages map: {0}".format(langs_map))
-        # Construct regex to catch all languages we are interested in
-        regex_lang = r'\s+({0})'.format('|'.join(langs_map.keys()).replace('ba', 'bs'))
-        regex_lang_match = re.compile(regex_lang, re.IGNORECASE)
 
         for url, data in subtitle_archives.items():
             # Check if subtitle is in list of languages
-            match = regex_lang_match.search(data[0])
-            if not match:
+            supp_country = pu.get_archive_language(data[0], langs_map)
+            if not supp_country:
                 continue
             subt_name = data[0]
             subt_suitable = data[1]
-            supp_country = match.group(1).lower()
-            if supp_country.find('irilic') > -1:
-                supp_country = 'sr'
 
             subt_lang = xbmc.convertLanguage(supp_country, xbmc.ISO_639_1)
             self.log.debug("Subtitle: url='{0}', subt_name='{1}', subt_suitable='{2}', lang={3}".format(
@@ -184,10 +369,26 @@ class ActionHandler(object):
                 listitem=list_item,
                 isFolder=False)
 
-    # Search with manually entered search phrase
+    # Search with manually entered search phrase,
+    # always asking the site again for shows and
+    # episodes recently not found
     def manual_search(self):
         search_term = self.params['searchstring'][0]
         self.log.notice("Searching subtitles with term '{0}'".format(search_term))
+        match = re.search(self.REGEX_MANUAL_SEARCH, search_term, re.IGNORECASE)
+        if not match:
+            self.show_notification(get_local_str(32008))
+            return
+        curr_show = self.get_current_show()
+        curr_show['tvshow_title'] = match.group(1)
+        curr_show['season'] = match.group(2).zfill(2)
+        curr_show['episode'] = match.group(3).zfill(2)
+        curr_show['mansearch'] = True
+        curr_show['cachedir'] = self.get_cache_dir(curr_show)
+        self.log.debug("Manually searched show: {0}".format(curr_show))
+        subtitle_archives = self.get_subtitle_archives(curr_show, use_misses=False)
+        if subtitle_archives:
+            self.list_subtitles(curr_show, subtitle_archives)
 
     # Downloading subtitles that were selected during "search"
     # or "manualsearch" invocation
@@ -200,59 +401,44 @@ class ActionHandler(object):
             self.log.debug("Subtitle download cancelled")
             self.add_subtitle_dir_item('', '')
             return
-        # Check if subtitles are already downloaded in cache directory
-        possible_subtitles = pu.get_possible_subtitles(
+        # Time user spent in dialog does not count
+        self.action_started = time.time()
+        # Check if subtitles are already downloaded, those from
+        # chosen archive come first, then those named after video
+        # file, then ones extracted from archive of another episode
+        possible_subtitles = self.index.find_subtitles(
             self.params['cachedir'][0],
+            self.params['lang'][0],
             self.params['filepath'][0],
-            self.params['lang'][0])
+            self.params['url'][0])
         if len(possible_subtitles) == 0:
-            self.log.debug("Downloading subtitles for '{0}'".format(self.params['filepath'][0]))
-            arch_name, arch_content = self.prev.get_subtitle_archive(self.params['url'][0])
-            archive_path = os.path.join(self.params['cachedir'][0], arch_name)
-            # Write to file because of unified archive interface
-            with open(archive_path, 'wb') as f:
-                f.write(arch_content)
-                f.close()
-            self.log.debug("Subtitle archive saved as '{0}'".format(archive_path))
-
-            archive = pa.Archive(archive_path, __resdata__)
-            archive.unrar_dir = __unrar__
-            archive.temp_dir = __temp__
-            archive.dialog = __progress__
-            archive.str_get_unrar = get_local_str(32023)
-            opersys, architecture = archive.get_platform_info()
-            self.log.debug("Platform ID: '{0}_{1}'".format(opersys, architecture))
-            log_str = archive.check_unrar_exe()
-            self.log.debug(log_str)
-            files = archive.list()
-            if len(files) == 0:
-                # Empty archive
-                self.log.error("No files in archive '{0}'".format(archive_path))
+            final_subtitle = self.fetch_from_site(
+                'fetch_subtitle',
+                url=self.params['url'][0],
+                cachedir=self.params['cachedir'][0],
+                filepath=self.params['filepath'][0],
+                lang=self.params['lang'][0])
+            if not final_subtitle:
                 return
-            else:
-                self.log.debug("Archive: files={0}".format(files))
-            archive_source = files[0]
-            archive_dest = self.params['cachedir'][0]
-            self.log.debug("Unpacking '{0}' to '{1}' using '{2}'".format(
-                archive_source, archive_dest, archive.get_dearchive_path()))
-            archive.extract(archive_source, archive_dest)
-            archive.remove()
-
-            # Rename subtitle accordingly
-            archive_dest = os.path.join(archive_dest, files[0])
-            final_subtitle = pu.get_subtitle_candidate(
-                self.params['filepath'][0],
-                self.params['lang'][0],
-                archive_dest.rpartition('.')[2])
-            final_subtitle = os.path.join(self.params['cachedir'][0], final_subtitle)
-            os.rename(archive_dest, final_subtitle)
-            self.log.debug("Renamed subtitle file '{0}' to '{1}'".format(archive_dest, final_subtitle))
             self.add_subtitle_dir_item(final_subtitle, self.params['lang'][0])
         else:
             self.log.debug("Using cached subtitles: {0}".format(possible_subtitles))
             # TODO: Handle case of more than one available subtitle
+            self.index.access_subtitle(possible_subtitles[0])
             self.add_subtitle_dir_item(possible_subtitles[0], self.params['lang'][0])
 
+    # After failed download, returns any subtitle
+    # in chosen language found in cache index
+    def add_stale_subtitle(self):
+        cached_subtitles = self.index.find_subtitles(
+            self.params['cachedir'][0],
+            self.params['lang'][0],
+            url=self.params['url'][0])
+        if cached_subtitles:
+            self.log.debug("Using stale cached subtitles: {0}".format(cached_subtitles))
+            self.index.access_subtitle(cached_subtitles[0])
+            self.add_subtitle_dir_item(cached_subtitles[0], self.params['lang'][0])
+
     # Adds directory item with subtitle file
     def add_subtitle_dir_item(self, subtitle_path, lang):
         # Copy subtitle to __temp__
@@ -336,15 +522,26 @@ class ActionHandler(object):
             item['tvshow_title'] = itemdata['tvshow_title']
             item['file_original_path'] = itemdata['filepath']
 
-        item['cachedir'] = os.path.join(__cache__, pu.get_cache_dir_title(item['tvshow_title']),
-                                        "{0}x{1}".format(item['season'], item['episode']))
+        item['cachedir'] = self.get_cache_dir(item)
         self.log.debug("Current show: {0}".format(item))
         return item
 
+    # Cache directory of show's episode
+    @staticmethod
+    def get_cache_dir(item):
+        return os.path.join(__cache__, pu.get_cache_dir_title(item['tvshow_title']),
+                            "{0}x{1}".format(item['season'], item['episode']))
+
 
 # end class ActionHandler
 
 handler = ActionHandler(sys.argv)
-handler.do()
-
-xbmcplugin.endOfDirectory(handler.handle)
+try:
+    handler.do()
+finally:
+    # Kodi waits for directory even if action failed
+    xbmcplugin.endOfDirectory(handler.handle)
+
+# Done after answer, so that it does not delay dialog
+handler.evict_cache()
+handler.report_imports()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Detached jobs started by addon.py through RunScript,
+# they run after the subtitle dialog got its answer
+#
+# Jobs:
+#  refresh <title> <season> <episode> <cachedir>
+#      Refreshes cached subtitle listing of episode
+
+# System modules
+import os
+import sys
+
+# Kodi modules
+import xbmc
+import xbmcaddon
+
+__addon__ = xbmcaddon.Addon()
+
+if sys.version_info[0] >= 3:
+    __cwd__ = xbmc.translatePath(__addon__.getAddonInfo('path'))
+    __profile__ = xbmc.translatePath(__addon__.getAddonInfo('profile'))
+    __resource__ = xbmc.translatePath(os.path.join(__cwd__, 'resources', 'lib'))
+else:
+    __cwd__ = xbmc.translatePath(__addon__.getAddonInfo('path')).decode("utf-8")
+    __profile__ = xbmc.translatePath(__addon__.getAddonInfo('profile')).decode("utf-8")
+    __resource__ = xbmc.translatePath(os.path.join(__cwd__, 'resources', 'lib')).decode("utf-8")
+
+sys.path.insert(0, __resource__)
+
+# Addon modules
+from prefetcher import Fetcher
+from prelogging import Prelogger
+from prevodi import PipelinedPrevodi
+import preutils as pu
+
+
+class BackgroundJob(object):
+    SETTINGS_USERNAME = 'prevodi-username'
+    SETTINGS_PASSWORD = 'prevodi-password'
+    SETTINGS_NEGATIVE_TTL = 'negative-cache-ttl'
+    SETTINGS_SEASONS_TTL = 'seasons-ttl'
+
+    def __init__(self, args):
+        self.log = Prelogger()
+        self.job = args[1] if len(args) > 1 else None
+        self.args = [pu.get_unquoted_str(arg.strip()) for arg in args[2:]]
+        self.prev = PipelinedPrevodi(
+            __addon__.getSetting(self.SETTINGS_USERNAME),
+            __addon__.getSetting(self.SETTINGS_PASSWORD),
+            __profile__)
+        self.prev.log = self.log
+        try:
+            self.prev.seasons_cache.ttl = int(__addon__.getSetting(self.SETTINGS_SEASONS_TTL)) * 24 * 60 * 60
+        except ValueError:
+            pass
+        try:
+            misses_ttl = int(__addon__.getSetting(self.SETTINGS_NEGATIVE_TTL)) * 60 * 60
+        except ValueError:
+            misses_ttl = 6 * 60 * 60
+        self.fetcher = Fetcher(self.prev, __profile__, misses_ttl)
+        self.fetcher.log = self.log
+        self.JOB_MAP = {
+            'refresh': self.refresh
+        }
+
+    def do(self):
+        if self.job not in self.JOB_MAP:
+            self.log.error("Unknown background job: {0}".format(self.job))
+            return
+        self.log.debug("Background job '{0}' started with: {1}".format(self.job, self.args))
+        try:
+            self.JOB_MAP[self.job]()
+        except Exception as e:
+            # Nobody waits for the result, just leave a trace
+            self.log.error("Background job '{0}' failed: {1}".format(self.job, e))
+            return
+        self.prev.save_session()
+
+    # Refreshes cached listing; misses are ignored since
+    # episode's listing is known to exist
+    def refresh(self):
+        tvshow_title, season, episode, cachedir = self.args
+        archives = self.fetcher.fetch_listing(tvshow_title, season, episode, cachedir, use_misses=False)
+        self.log.debug("Refreshed listing in '{0}': {1} archive(s)".format(
+            cachedir, len(archives) if archives else 0))
+
+
+# end class BackgroundJob
+
+BackgroundJob(sys.argv).do()
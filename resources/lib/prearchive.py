@@ -11,6 +11,7 @@ import platform
 import shutil
 import stat
 import sys
+import tempfile
 import zipfile
 
 import requests
@@ -19,39 +20,120 @@ import requests
 import rarfile
 
 
+# Signatures of supported archive types,
+# found at the very start of archive
+ARCHIVE_SIGNATURES = (
+    (rarfile.RAR5_ID, 'rar',),
+    (rarfile.RAR_ID, 'rar',),
+    (b'PK\x03\x04', 'zip',),
+    (b'PK\x05\x06', 'zip',),
+    (b'\x1f\x8b', 'gz',),
+)
+# Bytes needed to recognize any of the types
+SNIFF_SIZE = 8
+
+
 # Custom exception, easy to catch
 # all errors occurring in this class
 class ArchiveException(Exception):
     pass
 
 
+# Returns archive type ('rar', 'zip' or 'gz') from first
+# bytes of archive, None if type is not supported
+def sniff_archive_type(head):
+    for signature, archive_type in ARCHIVE_SIGNATURES:
+        if head.startswith(signature):
+            return archive_type
+    return None
+
+
+# Single gzip compressed subtitle, presented
+# as archive with one member
+class GzipArchive(object):
+
+    # Params:
+    #  source: Path to file, or file object
+    #  name: Name of compressed file
+    def __init__(self, source, name):
+        self.source = source
+        self.name = name
+
+    def namelist(self):
+        return [self.name]
+
+    def open(self, member):
+        if hasattr(self.source, 'read'):
+            self.source.seek(0)
+            return gzip.GzipFile(fileobj=self.source, mode='rb')
+        return gzip.open(self.source, 'rb')
+
+    def extract(self, member, path):
+        with self.open(member) as source, open(os.path.join(path, member), 'wb') as dest:
+            shutil.copyfileobj(source, dest)
+
+    def close(self):
+        pass
+
+
 class Archive(object):
+    # Resolved UnRAR executable, inside UnRAR directory
+    TOOL_RECORD_FILE = 'unrar-tool.json'
 
     # Params:
-    #  archive_path: Path to archive with subtitle
+    #  archive_path: Path to archive with subtitle, or
+    #                just its name if fileobj is given
     #  res_data: Data to addon's resource data directory
     #  unrar_dir: Path to directory with UnRAR executable
-    def __init__(self, archive_path, res_data):
+    #  fileobj: File object with archive content, for
+    #           archives kept in memory
+    def __init__(self, archive_path, res_data, fileobj=None):
         archive_suffix = archive_path.lower().split('.')[-1]
         self.resource_data = res_data
         self.unrar_dir = None
         self.temp_dir = None
         self.dialog = None
         self.str_get_unrar = None
-        if archive_suffix in ('rar', 'zip',):
+        self.in_memory = fileobj is not None
+        self.archive_path = archive_path
+        source = fileobj if self.in_memory else archive_path
+        # Content decides, suffix is used only when
+        # content is not recognized
+        archive_type = self.sniff(source)
+        if archive_type:
+            self.suffix = archive_type
+        elif archive_suffix in ('rar', 'zip',):
             self.suffix = archive_suffix
-            self.archive_path = archive_path
         else:
             raise ArchiveException("Cannot handle archive '{0}'".format(archive_path))
-        if self.suffix == 'zip':
-            self.archive = zipfile.ZipFile(archive_path, 'r')
+        try:
+            if self.suffix == 'zip':
+                self.archive = zipfile.ZipFile(source, 'r')
+            elif self.suffix == 'gz':
+                name = os.path.basename(archive_path)
+                self.archive = GzipArchive(source, name[:-3] if name.lower().endswith('.gz') else name)
+            else:
+                self.archive = rarfile.RarFile(source, 'r', errors='strict')
+        except:
+            # Damaged archive, e.g. truncated download
+            e = sys.exc_info()[1]
+            raise ArchiveException(e)
+        # UnRAR executable map, loaded only when
+        # executable has to be resolved
+        self.unrar = None
+
+    # Return:
+    #   Archive type from first bytes of file or file object
+    @staticmethod
+    def sniff(source):
+        if hasattr(source, 'read'):
+            position = source.tell()
+            head = source.read(SNIFF_SIZE)
+            source.seek(position)
         else:
-            self.archive = rarfile.RarFile(archive_path, 'r', errors='strict')
-            # Load UnRAR executable map
-            json_cfg = os.path.join(self.resource_data, "unrar.json")
-            with open(json_cfg, 'r') as f:
-                self.unrar = json.load(f)
-                f.close()
+            with open(source, 'rb') as f:
+                head = f.read(SNIFF_SIZE)
+        return sniff_archive_type(head)
 
     # List archive content
     # Return:
@@ -68,9 +150,55 @@ class Archive(object):
             e = sys.exc_info()[1]
             raise ArchiveException(e)
 
+    # Writes single member straight to its final path;
+    # stored RAR members are read directly, without UnRAR
+    def extract_to(self, member, dest_path):
+        try:
+            with self.archive.open(member) as source, open(dest_path, 'wb') as dest:
+                shutil.copyfileobj(source, dest)
+        except:
+            e = sys.exc_info()[1]
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            raise ArchiveException(e)
+
+    # Extracts several members, each to its own final path.
+    # RAR members that need UnRAR are extracted by single
+    # UnRAR run, since solid archive would otherwise be
+    # decompressed from the start for every member.
+    # Params:
+    #  plan: List of (member, destination path) pairs
+    def extract_members(self, plan):
+        if self.suffix != 'rar' or all(self._is_stored(member) for member, _ in plan):
+            for member, dest_path in plan:
+                self.extract_to(member, dest_path)
+            return
+        work_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        try:
+            self.archive.extractall(work_dir, [member for member, _ in plan])
+            for member, dest_path in plan:
+                if os.path.exists(dest_path):
+                    os.remove(dest_path)
+                shutil.move(os.path.join(work_dir, *member.split(rarfile.PATH_SEP)), dest_path)
+        except:
+            e = sys.exc_info()[1]
+            raise ArchiveException(e)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Checks if RAR member can be read directly, without UnRAR
+    def _is_stored(self, member):
+        info = self.archive.getinfo(member)
+        return info.compress_type == rarfile.RAR_M0 and not info.needs_password()
+
+    def close(self):
+        self.archive.close()
+
     def get_dearchive_path(self):
         if self.suffix == 'zip':
             return 'zipfile module'
+        elif self.suffix == 'gz':
+            return 'gzip module'
         else:
             return rarfile.UNRAR_TOOL
 
@@ -83,11 +211,94 @@ class Archive(object):
         arch_lower = arch.lower()
         return os_lower, arch_lower,
 
+    # Return:
+    #   Key of OS and architecture, cheaper to get
+    #   than platform.uname(), which may run programs
+    @staticmethod
+    def get_platform_key():
+        if hasattr(os, 'uname'):
+            machine = os.uname()[4]
+        else:
+            machine = os.environ.get('PROCESSOR_ARCHITECTURE', '')
+        return "{0}_{1}".format(sys.platform, machine.lower())
+
+    def get_tool_record_path(self):
+        return os.path.join(self.unrar_dir, self.TOOL_RECORD_FILE)
+
+    # Return:
+    #   Record of UnRAR executable resolved earlier, None if
+    #   there is none or it does not match platform and binary
+    def load_tool_record(self):
+        try:
+            with open(self.get_tool_record_path(), 'r') as f:
+                record = json.load(f)
+            if record['platform'] != self.get_platform_key() or not record['probe']:
+                return None
+            if os.path.getmtime(record['path']) != record['mtime']:
+                return None
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        return record
+
+    # Writes record to temporary file first, so that
+    # interrupted invocation cannot leave broken record
+    def save_tool_record(self, path, version):
+        record = {
+            'platform': self.get_platform_key(),
+            'path': path,
+            'mtime': os.path.getmtime(path),
+            'version': version,
+            'probe': True
+        }
+        record_path = self.get_tool_record_path()
+        temp_path = "{0}.tmp".format(record_path)
+        with open(temp_path, 'w') as f:
+            json.dump(record, f)
+        if os.name == 'nt' and os.path.exists(record_path):
+            os.remove(record_path)
+        os.rename(temp_path, record_path)
+
+    # Runs UnRAR executable once to see that it works
+    # Return:
+    #   First line of its output (name and version),
+    #   None if it cannot be executed
+    @staticmethod
+    def probe_unrar_tool(path):
+        try:
+            out = rarfile.custom_check([path], True)
+        except rarfile.RarCannotExec:
+            return None
+        lines = [line.strip() for line in out.decode('utf-8', 'replace').splitlines() if line.strip()]
+        return lines[0] if lines else ''
+
+    # Configures rarfile to use given UnRAR executable,
+    # without its own check of executable
+    @staticmethod
+    def use_unrar_tool(path):
+        rarfile.UNRAR_TOOL = path
+        rarfile.OPEN_ARGS = rarfile.ORIG_OPEN_ARGS
+        rarfile.EXTRACT_ARGS = rarfile.ORIG_EXTRACT_ARGS
+        rarfile.TEST_ARGS = rarfile.ORIG_TEST_ARGS
+        rarfile.TOOL_CHECKED = True
+
+    def load_unrar_map(self):
+        if self.unrar is None:
+            json_cfg = os.path.join(self.resource_data, "unrar.json")
+            with open(json_cfg, 'r') as f:
+                self.unrar = json.load(f)
+
     # Get unrar executable for specific OS and architecture
     # Addons cannot ship precompiled binaries
+    # Resolved and probed executable is recorded in profile,
+    # later invocations use it without resolving it again
     def check_unrar_exe(self):
-       if self.suffix != 'rar':
+        if self.suffix != 'rar':
             return "Archive not RAR"
+        record = self.load_tool_record()
+        if record:
+            self.use_unrar_tool(record['path'])
+            return "Using recorded UnRAR executable '{0}' ({1})".format(record['path'], record['version'])
+        self.load_unrar_map()
         los, arch = self.get_platform_info()
         if los == 'windows':
             pass
@@ -112,7 +323,14 @@ class Archive(object):
             fetched = True
         else:
             fetched = False
-        rarfile.UNRAR_TOOL = unrar_exe_path
+        version = self.probe_unrar_tool(unrar_exe_path)
+        if version is None:
+            # Not recorded, rarfile checks executable
+            # itself and falls back to alternative tool
+            rarfile.UNRAR_TOOL = unrar_exe_path
+        else:
+            self.use_unrar_tool(unrar_exe_path)
+            self.save_tool_record(unrar_exe_path, version)
         if fetched:
             return "Fetched UnRAR executable from '{0}' to '{1}'".format(
                 self.unrar["exe"][unrar_key]["source"], unrar_exe_path)
@@ -120,7 +338,8 @@ class Archive(object):
             return "Using existing UnRAR executable '{0}'".format(unrar_exe_path)
 
     def remove(self):
-        os.remove(self.archive_path)
+        if not self.in_memory:
+            os.remove(self.archive_path)
 
     # Fetches UnRAR executable from RarLAB site
     def _fetch_unrar_exe(self, unrar_key):
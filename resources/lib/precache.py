@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Small key-value cache with expiry, kept as
+# JSON file in addon profile directory
+
+import json
+import os
+import threading
+import time
+
+
+# Return:
+#  Signature of file that changes whenever file is
+#  written or replaced, None if there is no file
+def get_file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime, st.st_size,
+
+
+class JsonCache(object):
+
+    # Params:
+    #  cache_path: Path to JSON file, cache is kept
+    #              only in memory if omitted
+    #  ttl: Default time to live of entries, in seconds
+    def __init__(self, cache_path, ttl):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.entries = dict()
+        # Same cache may be shared by worker threads
+        self.lock = threading.Lock()
+        self.signature = None
+        self._load()
+
+    # Loads entries again if file was changed since, file is
+    # shared with other invocations and long running service
+    def _load(self):
+        if not self.cache_path:
+            return
+        signature = get_file_signature(self.cache_path)
+        if signature is None or signature == self.signature:
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            # Being replaced, loaded next time
+            return
+        self.signature = signature
+
+    # Writes entries to temporary file first, so that
+    # interrupted invocation cannot leave broken cache;
+    # expired entries are dropped, file does not grow
+    # with entries nobody uses any more
+    def _save(self):
+        if not self.cache_path:
+            return
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry['expires'] <= now]:
+            del self.entries[key]
+        temp_path = "{0}.tmp".format(self.cache_path)
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f)
+        if os.name == 'nt' and os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+        os.rename(temp_path, self.cache_path)
+        self.signature = get_file_signature(self.cache_path)
+
+    # Return:
+    #  Cached value, or None if missing or expired
+    #  (unless stale value is explicitly allowed)
+    def get(self, key, allow_stale=False):
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry['expires'] <= time.time() and not allow_stale:
+            return None
+        return entry['value']
+
+    # Params:
+    #  ttl: Time to live in seconds, default TTL if omitted
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            # Entries written by others meanwhile are kept
+            self._load()
+            self.entries[key] = {
+                'value': value,
+                'stored': now,
+                'expires': now + ttl
+            }
+            self._save()
+
+    # Shortens life of entry to given TTL, counted from
+    # when it was stored; longer life is left as it is
+    def limit_ttl(self, key, ttl):
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+            if entry is None or entry['expires'] <= entry['stored'] + ttl:
+                return
+            entry['expires'] = entry['stored'] + ttl
+            self._save()
+
+    def invalidate(self, key):
+        with self.lock:
+            self._load()
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    # Return:
+    #  Seconds since entry was stored, None if missing
+    def age(self, key):
+        with self.lock:
+            self._load()
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return time.time() - entry['stored']
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# Errors of prijevodi site client, kept apart from it so
+# that callers can catch them without importing network stack
+
+
+# Custom exception, easy to catch
+# all errors occurring in this class
+class PrevodException(Exception):
+    pass
+
+
+# Raised when site rejects given credentials
+class PrevodLoginException(PrevodException):
+    pass
+
+
+# Raised when show or episode does not exist on site
+class PrevodNotFoundException(PrevodException):
+    pass
+
+
+# Raised when site refuses request, e.g. forbidden resource
+class PrevodRejectedException(PrevodException):
+    pass
+
+
+# Raised when site does not answer in time
+# or action's time budget is used up
+class PrevodTimeoutException(PrevodException):
+    pass
+
+
+# Raised when site is down, or considered down
+# after several consecutive failures
+class PrevodUnavailableException(PrevodException):
+    pass
+
+
+# Raised when downloaded archive cannot be read
+class PrevodArchiveException(PrevodException):
+    pass
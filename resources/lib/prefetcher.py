@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+# Fetches subtitle listings of episodes into cache index,
+# shared by plugin and background jobs
+
+import os
+
+# Kodi modules
+import xbmc
+
+# Addon-specific modules
+from precache import JsonCache
+from preerrors import PrevodArchiveException, PrevodNotFoundException
+from preindex import CacheIndex
+import preutils as pu
+
+
+class Fetcher(object):
+    # Shows and episodes that could not be found
+    MISSES_FILE = 'misses.json'
+
+    # Params:
+    #  prev: Prevodi instance
+    #  profile_dir: Addon profile directory
+    #  misses_ttl: How long shows and episodes not found
+    #              are remembered, in seconds
+    def __init__(self, prev, profile_dir, misses_ttl):
+        self.prev = prev
+        # Searches without wanted show count as misses
+        self.prev.search_miss_ttl = misses_ttl
+        self.misses = JsonCache(os.path.join(profile_dir, self.MISSES_FILE), misses_ttl)
+        self.index = CacheIndex(os.path.join(profile_dir, CacheIndex.INDEX_FILE))
+        self.log = None
+        # Passed to archive handler, set by caller
+        self.res_data = None
+        self.unrar_dir = None
+        self.temp_dir = None
+        self.dialog = None
+        self.str_get_unrar = None
+
+    def _debug(self, message):
+        if self.log:
+            self.log.debug(message)
+
+    def _error(self, message):
+        if self.log:
+            self.log.error(message)
+
+    # Gets subtitle archives of episode from prijevodi
+    # and saves them to cache index
+    # Params:
+    #  tvshow_title: Exact show title
+    #  season, episode: Zero-padded numbers
+    #  cachedir: Episode's cache directory
+    #  use_misses: Skip shows and episodes recently not found
+    #  use_search_cache: Take search results from cache,
+    #                    otherwise site is searched again
+    # Return:
+    #  Subtitle archives, None if there are none
+    def fetch_listing(self, tvshow_title, season, episode, cachedir, use_misses=True, use_search_cache=True):
+        show_key = self.get_show_key(tvshow_title)
+        episode_key = self.get_episode_key(tvshow_title, season, episode)
+        if use_misses:
+            for key in show_key, episode_key:
+                if self.misses.get(key):
+                    self._debug(u"Recently not found, skipping search: '{0}'".format(key))
+                    return None
+        try:
+            self.load_tv_show(tvshow_title, use_cache=use_search_cache)
+        except PrevodNotFoundException as e:
+            self._error(e)
+            self.misses.set(show_key, True)
+            return None
+        try:
+            self.prev.get_subtitles(season, episode)
+        except PrevodNotFoundException as e:
+            self._error(e)
+            self.misses.set(episode_key, True)
+            return None
+        if not self.prev.archives:
+            self._debug(u"No subtitles for '{0}'".format(episode_key))
+            self.misses.set(episode_key, True)
+            return None
+        self.index.set_listing(cachedir, self.prev.archives)
+        self.misses.invalidate(show_key)
+        self.misses.invalidate(episode_key)
+        return self.prev.archives
+
+    # Gets subtitle archives of several episodes of show
+    # concurrently and saves them to cache index
+    # Params:
+    #  episodes: List of (season, episode) pairs
+    #  show_cachedir: Show's cache directory
+    #  workers: Number of concurrent requests
+    #  use_misses, use_search_cache: See fetch_listing()
+    # Return:
+    #  Dictionary (season, episode) -> archives, for
+    #  episodes that have subtitles
+    def fetch_listings(self, tvshow_title, episodes, show_cachedir, workers=4, use_misses=True,
+                       use_search_cache=True):
+        show_key = self.get_show_key(tvshow_title)
+        if use_misses and self.misses.get(show_key):
+            self._debug(u"Recently not found, skipping search: '{0}'".format(show_key))
+            return dict()
+        try:
+            self.load_tv_show(tvshow_title, use_cache=use_search_cache)
+        except PrevodNotFoundException as e:
+            self._error(e)
+            self.misses.set(show_key, True)
+            return dict()
+        self.misses.invalidate(show_key)
+        if use_misses:
+            episodes = [(seas, epis) for seas, epis in episodes
+                        if not self.misses.get(self.get_episode_key(tvshow_title, seas, epis))]
+        listings = dict()
+        for (season, episode), archives in self.prev.get_subtitles_batch(episodes, workers).items():
+            episode_key = self.get_episode_key(tvshow_title, season, episode)
+            if archives:
+                self.index.set_listing(os.path.join(show_cachedir, "{0}x{1}".format(season, episode)), archives)
+                self.misses.invalidate(episode_key)
+                listings[(season, episode)] = archives
+            elif archives is not None:
+                self._debug(u"No subtitles for '{0}'".format(episode_key))
+                self.misses.set(episode_key, True)
+        return listings
+
+    @staticmethod
+    def get_show_key(tvshow_title):
+        return u"show:{0}".format(tvshow_title.lower())
+
+    @staticmethod
+    def get_episode_key(tvshow_title, season, episode):
+        return u"episode:{0}:{1}x{2}".format(tvshow_title.lower(), season, episode)
+
+    # Searches prijevodi and loads season map of show,
+    # unless it is already loaded
+    # Params:
+    #  use_cache: Use loaded show and cached search results;
+    #             otherwise site is asked again
+    def load_tv_show(self, tvshow_title, use_cache=True):
+        if use_cache and self.prev.tv_show == tvshow_title and self.prev.seasons:
+            return
+        self.prev.search(tvshow_title, use_cache)
+        self.prev.get_tv_show(tvshow_title)
+
+    # Downloads subtitle archive and extracts subtitle
+    # into episode's cache directory
+    # Params:
+    #  url: Archive link, as found in listing
+    #  cachedir: Episode's cache directory
+    #  filepath: Path of video file, subtitle gets its name
+    #  lang: ISO 639-1 language code
+    # Return:
+    #  Path to subtitle, None if archive is empty
+    def fetch_subtitle(self, url, cachedir, filepath, lang):
+        # Archive handling (and rarfile with it) is imported only
+        # for downloads, searches do not need it
+        import prearchive as pa
+        # Unsupported archives are recognized by their
+        # first bytes, before they are downloaded
+        self.prev.archive_check = pa.sniff_archive_type
+        self.prev.archive_check_size = pa.SNIFF_SIZE
+        self._debug("Downloading subtitles for '{0}'".format(filepath))
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        arch_name, arch_file = self.prev.get_subtitle_archive(url, cachedir)
+        try:
+            return self.extract_subtitle(arch_name, arch_file, url, cachedir, filepath, lang)
+        except pa.ArchiveException as e:
+            if not hasattr(arch_file, 'read') and os.path.exists(arch_file):
+                os.remove(arch_file)
+            # Reported by plugin as failed download, same as site errors
+            raise PrevodArchiveException("Cannot read archive '{0}': {1}".format(arch_name, e))
+
+    # Extracts subtitle from downloaded archive
+    # Params:
+    #  arch_name: Name of archive
+    #  arch_file: Path to archive, or file object with its content
+    # Return:
+    #  Path to subtitle, None if archive is empty
+    def extract_subtitle(self, arch_name, arch_file, url, cachedir, filepath, lang):
+        import prearchive as pa
+        if hasattr(arch_file, 'read'):
+            self._debug("Subtitle archive '{0}' kept in memory".format(arch_name))
+            archive = pa.Archive(arch_name, self.res_data, fileobj=arch_file)
+        else:
+            self._debug("Subtitle archive saved as '{0}'".format(arch_file))
+            archive = pa.Archive(arch_file, self.res_data)
+        archive.unrar_dir = self.unrar_dir
+        archive.temp_dir = self.temp_dir
+        archive.dialog = self.dialog
+        archive.str_get_unrar = self.str_get_unrar
+        log_str = archive.check_unrar_exe()
+        self._debug(log_str)
+        files = archive.list()
+        if len(files) == 0:
+            # Empty archive
+            self._error("No files in archive '{0}'".format(arch_name))
+            archive.close()
+            archive.remove()
+            return None
+        else:
+            self._debug("Archive: files={0}".format(files))
+        final_subtitle, plan = self.plan_extraction(files, cachedir, filepath, lang)
+        # All subtitles are extracted in one pass, each written
+        # once under its final name, so that season packs serve
+        # other episodes from cache
+        for archive_source, archive_dest in plan:
+            self._debug("Unpacking '{0}' to '{1}' using '{2}'".format(
+                archive_source, archive_dest, archive.get_dearchive_path()))
+            if not os.path.exists(os.path.dirname(archive_dest)):
+                os.makedirs(os.path.dirname(archive_dest))
+        try:
+            archive.extract_members(plan)
+        finally:
+            archive.close()
+            archive.remove()
+        for _, archive_dest in plan:
+            if os.path.exists(archive_dest):
+                self.index.add_subtitle(archive_dest, lang, url)
+        if not final_subtitle:
+            self._error("No subtitle for episode '{0}' in archive '{1}'".format(cachedir, arch_name))
+        return final_subtitle
+
+    # Downloads first archive in each of given languages,
+    # unless subtitle in that language is already cached
+    # Params:
+    #  langs_map: Languages, as returned by preutils.get_language_list()
+    # Return:
+    #  List of paths to downloaded subtitles
+    def fetch_preferred_subtitles(self, archives, cachedir, filepath, langs_map):
+        done = set()
+        subtitles = list()
+        for url, data in archives.items():
+            supp_country = pu.get_archive_language(data[0], langs_map)
+            if not supp_country or supp_country in done:
+                continue
+            lang = xbmc.convertLanguage(supp_country, xbmc.ISO_639_1)
+            done.add(supp_country)
+            if self.index.find_subtitles(cachedir, lang):
+                continue
+            subtitle = self.fetch_subtitle(url, cachedir, filepath, lang)
+            if subtitle:
+                subtitles.append(subtitle)
+        return subtitles
+
+    # Decides where each subtitle in archive goes: members marked
+    # with another episode (SxxEyy, NxNN) go to that episode's cache
+    # directory, named after member; member matching video file best
+    # is named after video file, other variants after themselves
+    # Params:
+    #  files: Archive members
+    #  cachedir: Cache directory of requested episode
+    # Return:
+    #  Path of subtitle for requested episode (None if
+    #  there is none) and list of (member, path) pairs
+    def plan_extraction(self, files, cachedir, filepath, lang):
+        members = [name for name in files if pu.is_subtitle_file(name)]
+        if not members:
+            # Unknown extensions, take whatever file is there
+            members = [name for name in files if not name.endswith('/')][:1]
+        current = pu.get_episode_marker(os.path.basename(cachedir))
+        show_cachedir = os.path.dirname(cachedir)
+        current_members = list()
+        plan = list()
+        for member in members:
+            member_name = member.replace('\\', '/').split('/')[-1]
+            marker = pu.get_episode_marker(member_name)
+            ext = member_name.rpartition('.')[2]
+            if marker is None or marker == current:
+                current_members.append(member)
+            else:
+                dest_dir = os.path.join(show_cachedir, "{0}x{1}".format(*marker))
+                plan.append((member, os.path.join(dest_dir, pu.get_subtitle_candidate(member_name, lang, ext)),))
+        if not current_members:
+            return None, plan,
+        best = max(current_members, key=lambda name: pu.get_name_similarity(name, filepath))
+        final_subtitle = os.path.join(
+            cachedir, pu.get_subtitle_candidate(filepath, lang, best.rpartition('.')[2]))
+        plan.insert(0, (best, final_subtitle,))
+        for member in current_members:
+            if member != best:
+                member_name = member.replace('\\', '/').split('/')[-1]
+                plan.append((member, os.path.join(
+                    cachedir, pu.get_subtitle_candidate(member_name, lang, member_name.rpartition('.')[2])),))
+        return final_subtitle, plan,
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+# Minimal replacement of Kodi modules, so that addon
+# modules can be used from command line outside of Kodi
+
+import sys
+import types
+
+# Print debug messages too
+VERBOSE = False
+
+
+# Progress dialog printing to standard error
+class ConsoleProgress(object):
+
+    def create(self, heading, message=''):
+        sys.stderr.write("{0} {1}\n".format(heading, message))
+
+    def update(self, percent, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+def _make_xbmc():
+    xbmc = types.ModuleType('xbmc')
+    xbmc.LOGDEBUG = 0
+    xbmc.LOGINFO = 1
+    xbmc.LOGNOTICE = 2
+    xbmc.LOGWARNING = 3
+    xbmc.LOGERROR = 4
+    xbmc.ISO_639_1 = 0
+    xbmc.ISO_639_2 = 1
+
+    def log(msg, level=xbmc.LOGDEBUG):
+        if level == xbmc.LOGDEBUG and not VERBOSE:
+            return
+        if isinstance(msg, bytes) and sys.version_info[0] >= 3:
+            msg = msg.decode('utf-8')
+        sys.stderr.write("{0}\n".format(msg))
+
+    # Language codes used by addon already are ISO 639-1
+    def convertLanguage(language, lang_format):
+        return language
+
+    def translatePath(path):
+        return path
+
+    xbmc.log = log
+    xbmc.convertLanguage = convertLanguage
+    xbmc.translatePath = translatePath
+    return xbmc
+
+
+def _make_xbmcgui():
+    xbmcgui = types.ModuleType('xbmcgui')
+    xbmcgui.DialogProgress = ConsoleProgress
+    xbmcgui.DialogProgressBG = ConsoleProgress
+    return xbmcgui
+
+
+# Registers fake modules, must be called
+# before any addon module is imported
+def install():
+    sys.modules.setdefault('xbmc', _make_xbmc())
+    sys.modules.setdefault('xbmcgui', _make_xbmcgui())
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+# Index of subtitle cache, kept as SQLite database in addon
+# profile directory: episode listings and subtitles extracted
+# into episode cache directories, so that lookups are single
+# indexed queries instead of file checks and globbing
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Addon-specific module
+import preutils as pu
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS listings (
+        show TEXT NOT NULL,
+        season TEXT NOT NULL,
+        episode TEXT NOT NULL,
+        archives TEXT NOT NULL,
+        fetched REAL NOT NULL,
+        accessed REAL NOT NULL,
+        PRIMARY KEY (show, season, episode))""",
+    """CREATE INDEX IF NOT EXISTS listings_accessed ON listings (accessed)""",
+    """CREATE TABLE IF NOT EXISTS subtitles (
+        path TEXT PRIMARY KEY,
+        show TEXT NOT NULL,
+        season TEXT NOT NULL,
+        episode TEXT NOT NULL,
+        language TEXT NOT NULL,
+        url TEXT,
+        size INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        fetched REAL NOT NULL,
+        accessed REAL NOT NULL)""",
+    """CREATE INDEX IF NOT EXISTS subtitles_episode ON subtitles (show, season, episode, language)""",
+    """CREATE INDEX IF NOT EXISTS subtitles_accessed ON subtitles (accessed)""",
+)
+
+
+# Return:
+#   Show, season and episode of episode's cache
+#   directory, which is <cache>/<show>/<season>x<episode>
+def split_cachedir(cachedir):
+    show_cachedir, episode_dir = os.path.split(os.path.normpath(cachedir))
+    season, _, episode = episode_dir.partition('x')
+    return os.path.basename(show_cachedir), season, episode,
+
+
+class CacheIndex(object):
+    INDEX_FILE = 'cache.db'
+
+    # Params:
+    #  index_path: Path to database file
+    def __init__(self, index_path):
+        self.index_path = index_path
+        # Same index may be shared by worker threads, other
+        # invocations use their own connections
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(index_path, timeout=10, check_same_thread=False)
+        # Readers do not block writer of another invocation
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock, self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    # Return:
+    #  Cached subtitle archives of episode and age of
+    #  listing in seconds, None if listing is not cached
+    def get_listing(self, cachedir):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT archives, fetched FROM listings WHERE show = ? AND season = ? AND episode = ?",
+                split_cachedir(cachedir)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), time.time() - row[1],
+
+    # Return:
+    #  Cached subtitle archives of episode, None if not cached
+    def load_listing(self, cachedir):
+        listing = self.get_listing(cachedir)
+        return listing[0] if listing else None
+
+    # Saves episode's subtitle archives,
+    # replacing previous listing
+    def set_listing(self, cachedir, subtitle_archives):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)",
+                split_cachedir(cachedir) + (json.dumps(subtitle_archives), now, now,))
+
+    # Marks cached listing as fresh without changing it
+    def touch_listing(self, cachedir):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE listings SET fetched = ? WHERE show = ? AND season = ? AND episode = ?",
+                (time.time(),) + split_cachedir(cachedir))
+
+    # Marks cached listing as used, for eviction
+    # of least recently used entries
+    def access_listing(self, cachedir):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE listings SET accessed = ? WHERE show = ? AND season = ? AND episode = ?",
+                (time.time(),) + split_cachedir(cachedir))
+
+    # Marks cached subtitle as used, for eviction
+    # of least recently used entries
+    def access_subtitle(self, path):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE subtitles SET accessed = ? WHERE path = ?", (time.time(), path,))
+
+    def has_subtitle(self, path):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM subtitles WHERE path = ?", (path,)).fetchone() is not None
+
+    # Adds subtitle extracted into episode's cache directory
+    # Params:
+    #  path: Path to subtitle, inside episode's cache directory
+    #  language: ISO 639-1 language code
+    #  url: Link of archive subtitle comes from
+    def add_subtitle(self, path, language, url):
+        with open(path, 'rb') as f:
+            content = f.read()
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO subtitles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path,) + split_cachedir(os.path.dirname(path)) + (
+                    language, url, len(content), hashlib.sha1(content).hexdigest(), now, now,))
+
+    # Return:
+    #  Paths to cached subtitles of episode in given language;
+    #  subtitles from archive with given link come first, then
+    #  (if file path of video is given) subtitles named after it
+    def find_subtitles(self, cachedir, language, file_path=None, url=None):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, url FROM subtitles WHERE show = ? AND season = ? AND episode = ? AND language = ? "
+                "ORDER BY path",
+                split_cachedir(cachedir) + (language,)).fetchall()
+        # Files may have been removed behind index's back
+        missing = [path for path, _ in rows if not os.path.exists(path)]
+        if missing:
+            self.remove_subtitles(missing)
+            rows = [row for row in rows if row[0] not in missing]
+        candidate = pu.get_subtitle_candidate(file_path, language) if file_path else None
+        rows.sort(key=lambda row: (
+            url is not None and row[1] != url,
+            candidate is not None and not os.path.basename(row[0]).startswith(candidate),))
+        return [path for path, _ in rows]
+
+    def remove_subtitles(self, paths):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM subtitles WHERE path = ?", [(path,) for path in paths])
+
+    # Removes listings not used since given time
+    # Params:
+    #  limit: Most listings to remove, oldest first
+    # Return:
+    #  Number of removed listings
+    def evict_listings(self, before, limit):
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM listings WHERE rowid IN "
+                "(SELECT rowid FROM listings WHERE accessed < ? ORDER BY accessed LIMIT ?)", (before, limit,)).rowcount
+
+    # Removes subtitles not used since given time,
+    # subtitle files are removed with their entries
+    # Params:
+    #  limit: Most subtitles to remove, oldest first
+    # Return:
+    #  Paths of removed subtitles
+    def evict_subtitles(self, before, limit):
+        with self.lock:
+            paths = [row[0] for row in self.conn.execute(
+                "SELECT path FROM subtitles WHERE accessed < ? ORDER BY accessed LIMIT ?", (before, limit,))]
+        return self._remove_subtitle_files(paths)
+
+    # Removes least recently used subtitles that do not
+    # fit into limits, with their files
+    # Params:
+    #  max_entries: Most subtitles to keep, no limit if 0
+    #  max_size: Most bytes of subtitles to keep, no limit if 0
+    #  limit: Most subtitles to remove, oldest first
+    # Return:
+    #  Paths of removed subtitles
+    def evict_over_quota(self, max_entries, max_size, limit):
+        with self.lock:
+            rows = self.conn.execute("SELECT path, size FROM subtitles ORDER BY accessed DESC").fetchall()
+        total = 0
+        for position, (path, size) in enumerate(rows):
+            total += size
+            if (max_entries and position >= max_entries) or (max_size and total > max_size):
+                # This one and all used before it
+                return self._remove_subtitle_files([row[0] for row in reversed(rows[position:])][:limit])
+        return list()
+
+    def _remove_subtitle_files(self, paths):
+        self.remove_subtitles(paths)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+            # Episode's cache directory goes with its last subtitle
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+        return paths
+
+
+# Evicts cache a little at a time: at most once per interval,
+# within time budget, continuing where previous run stopped.
+# Marker file in addon profile directory is shared by plugin
+# invocations and service; its modification time is time of
+# previous run, its content subdirectory of cache directory
+# sweep of files stopped after (empty when sweep finished)
+# Least recently used entries go first, when they are not
+# used for longer than their TTL or do not fit into limits
+class CacheEviction(object):
+    MARKER_FILE = 'eviction.marker'
+    # Seconds between runs
+    INTERVAL = 6 * 60 * 60
+    # Index entries removed at once
+    BATCH_SIZE = 50
+
+    # Params:
+    #  index: CacheIndex instance
+    #  cache_dir: Cache directory
+    #  marker_path: Path to marker file
+    def __init__(self, index, cache_dir, marker_path):
+        self.index = index
+        self.cache_dir = cache_dir
+        self.marker_path = marker_path
+        # Entries not used for this long are removed, in seconds
+        self.listing_ttl = 3 * 24 * 60 * 60
+        self.subtitle_ttl = 14 * 24 * 60 * 60
+        # Limits of cached subtitles, least recently
+        # used ones go first; no limit if 0
+        self.max_entries = 0
+        self.max_size = 0
+
+    # Return:
+    #  True if previous run did not finish, or
+    #  there was no run during interval
+    def is_due(self):
+        try:
+            marker = os.stat(self.marker_path)
+        except OSError:
+            return True
+        return marker.st_size > 0 or marker.st_mtime + self.INTERVAL <= time.time()
+
+    # Params:
+    #  budget: Seconds to spend
+    # Return:
+    #  Removed items
+    def run(self, budget):
+        now = time.time()
+        stop_at = now + budget
+        items = list()
+        # Index gives least recently used entries first
+        while time.time() < stop_at:
+            if self.index.evict_listings(now - self.listing_ttl, self.BATCH_SIZE) < self.BATCH_SIZE:
+                break
+        while time.time() < stop_at:
+            removed = self.index.evict_subtitles(now - self.subtitle_ttl, self.BATCH_SIZE)
+            items.extend(removed)
+            if len(removed) < self.BATCH_SIZE:
+                break
+        while time.time() < stop_at:
+            removed = self.index.evict_over_quota(self.max_entries, self.max_size, self.BATCH_SIZE)
+            items.extend(removed)
+            if len(removed) < self.BATCH_SIZE:
+                break
+        # Files index does not know about, those it knows
+        # about are removed by their last use only
+        resume_after = None
+        if os.path.exists(self.marker_path):
+            with io.open(self.marker_path, 'r', encoding='utf-8') as f:
+                resume_after = f.read() or None
+        # Index entries left over come first next time
+        index_done = time.time() < stop_at
+        if index_done and os.path.isdir(self.cache_dir):
+            swept, resume_after = pu.remove_older_than(
+                self.cache_dir,
+                self.subtitle_ttl / (24.0 * 60 * 60),
+                resume_after,
+                max(stop_at - time.time(), 0),
+                self.index.has_subtitle)
+            items.extend(swept)
+        temp_path = "{0}.tmp".format(self.marker_path)
+        with io.open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(pu.string_unicode(resume_after or ''))
+        if os.name == 'nt' and os.path.exists(self.marker_path):
+            os.remove(self.marker_path)
+        os.rename(temp_path, self.marker_path)
+        if not index_done:
+            # Marker as old as no run at all, so it is due
+            os.utime(self.marker_path, (0, 0,))
+        return items
@@ -9,7 +9,7 @@ class Prelogger(object):
     @staticmethod
     def dolog(txt, log_level):
         if version_info[0] >= 3:
-            message = '[prijevodi-online.org]: {0}'.format(txt.encode('utf-8'))
+            message = '[prijevodi-online.org]: {0}'.format(txt)
         else:
             if isinstance(txt, str):
                 txt = txt.decode("utf-8")
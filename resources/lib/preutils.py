@@ -2,14 +2,26 @@
 
 # Various helper functions
 
-import glob
 import os
 import re
 import sys
 import time
 import unicodedata
-import urlparse
-from urllib import quote_plus
+try:
+    import urlparse
+    from urllib import quote_plus, unquote_plus
+except ImportError:
+    import urllib.parse as urlparse
+    from urllib.parse import quote_plus, unquote_plus
+
+
+# Extensions of subtitle files found in archives
+SUBTITLE_EXTENSIONS = ('srt', 'sub', 'ass', 'ssa', 'smi', 'vtt',)
+# Episode markers in file names, e.g. S01E02 or 1x02
+REGEX_EPISODE_MARKERS = (
+    r'[Ss](\d{1,2})[ ._-]?[Ee](\d{1,3})',
+    r'(?<!\d)(\d{1,2})x(\d{2,3})(?!\d)',
+)
 
 
 # Fixes unicode problems
@@ -42,6 +54,11 @@ def get_quoted_str(param_string):
     return quote_plus(param_string)
 
 
+# Reverses get_quoted_str
+def get_unquoted_str(param_string):
+    return string_unicode(unquote_plus(param_string))
+
+
 def get_cache_dir_title(param_string):
     pattern = r'\-{2,}'
     filename = re.sub(pattern, '-', param_string.replace('_', '-').replace(' ', '-'))
@@ -67,6 +84,22 @@ def get_language_list(param_string):
     return ret_map
 
 
+# Returns language of subtitle archive from its description,
+# None if it is not one of the languages in map
+def get_archive_language(description, langs_map):
+    if not langs_map:
+        return None
+    # Construct regex to catch all languages we are interested in
+    regex_lang = r'\s+({0})'.format('|'.join(langs_map.keys()).replace('ba', 'bs'))
+    match = re.search(regex_lang, description, re.IGNORECASE)
+    if not match:
+        return None
+    supp_country = match.group(1).lower()
+    if supp_country.find('irilic') > -1:
+        supp_country = 'sr'
+    return supp_country
+
+
 # Returns subtitle candidate name
 def get_subtitle_candidate(file_path, lang, ext=''):
     # Get just filename
@@ -74,39 +107,82 @@ def get_subtitle_candidate(file_path, lang, ext=''):
     return ".".join(filename.split('.')[:-1] + [lang, ext])
 
 
-# Returns possible subtitles for given media and language
-def get_possible_subtitles(cache_dir, file_path, language):
-    candidate = get_subtitle_candidate(file_path, language, '*')
-    subtitle_mask = os.path.join(cache_dir, candidate)
-    return glob.glob(subtitle_mask)
-
-
-# Remove subdirectories from given directory
-# that are older than N days
-def remove_older_than(top_level, days):
-    def remove(path):
-        if os.path.isdir(path):
-            try:
-                os.rmdir(path)
-            except OSError:
-                raise Exception("Unable to remove folder '{0}'".format(path))
-        else:
-            try:
-                if os.path.exists(path):
-                    os.remove(path)
-            except OSError:
-                raise Exception("Unable to remove file '{0}'".format(path))
-
-    time_in_secs = time.time() - (days * 24 * 60 * 60)
+# Checks if archive member looks like subtitle file
+def is_subtitle_file(file_name):
+    return file_name.lower().rpartition('.')[2] in SUBTITLE_EXTENSIONS
+
+
+# Returns zero-padded season and episode from file
+# name, None if it has no episode marker
+def get_episode_marker(file_name):
+    for regex in REGEX_EPISODE_MARKERS:
+        match = re.search(regex, file_name)
+        if match:
+            return match.group(1).zfill(2), match.group(2).zfill(2),
+    return None
+
+
+# Returns number of words two file names have in common,
+# used to pick release variant matching video file
+def get_name_similarity(name, other_name):
+    def words(text):
+        return set(word for word in re.split(r'[^a-z0-9]+', text.lower()) if word)
+    return len(words(name.split('/')[-1]) & words(other_name.split('/')[-1]))
+
+
+# Returns (path, is directory, modification time) of each entry
+# in directory, os.scandir saves stat calls where it exists
+def scan_dir(path):
+    if hasattr(os, 'scandir'):
+        return [(entry.path, entry.is_dir(), entry.stat().st_mtime,) for entry in os.scandir(path)]
+    entries = list()
+    for name in os.listdir(path):
+        full_path = os.path.join(path, name)
+        entries.append((full_path, os.path.isdir(full_path), os.path.getmtime(full_path),))
+    return entries
+
+
+# Removes files older than given time below given path,
+# except those to keep, and directories left empty
+def _remove_expired(path, expires, keep, items):
+    for full_path, is_dir, mtime in scan_dir(path):
+        if is_dir:
+            _remove_expired(full_path, expires, keep, items)
+            if not os.listdir(full_path):
+                os.rmdir(full_path)
+                items.append(full_path)
+        elif mtime <= expires and not (keep and keep(full_path)):
+            os.remove(full_path)
+            items.append(full_path)
+
+
+# Remove files older than N days from subdirectories of given
+# directory, and subdirectories left empty; subdirectories are
+# swept in name order, until time budget is used up
+# Params:
+#  resume_after: Subdirectory previous sweep stopped after
+#  budget: Seconds to spend, no limit if omitted
+#  keep: Callable telling which old files to keep
+# Return:
+#  Removed items, and subdirectory sweep stopped after
+#  (None if all remaining subdirectories were swept)
+def remove_older_than(top_level, days, resume_after=None, budget=None, keep=None):
+    expires = time.time() - (days * 24 * 60 * 60)
+    stop_at = time.time() + budget if budget is not None else None
     items = list()
-    for root, dirs, files in os.walk(top_level, topdown=False):
-        for file_ in files:
-            full_path = os.path.join(root, file_)
-            stat = os.stat(full_path)
-            if stat.st_mtime <= time_in_secs:
-                remove(full_path)
+    for name in sorted(os.listdir(top_level)):
+        if resume_after is not None and name <= resume_after:
+            continue
+        full_path = os.path.join(top_level, name)
+        if os.path.isdir(full_path):
+            _remove_expired(full_path, expires, keep, items)
+            if not os.listdir(full_path):
+                os.rmdir(full_path)
                 items.append(full_path)
-        if not os.listdir(root):
-            remove(root)
-            items.append(root)
-    return items
+        elif os.path.getmtime(full_path) <= expires and not (keep and keep(full_path)):
+            os.remove(full_path)
+            items.append(full_path)
+        # At least one subdirectory is swept each time
+        if stop_at is not None and time.time() >= stop_at:
+            return items, name,
+    return items, None,
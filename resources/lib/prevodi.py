@@ -4,15 +4,118 @@ try:
     from HTMLParser import HTMLParser
 except ModuleNotFoundError:
     from html.parser import HTMLParser
+from email.utils import mktime_tz, parsedate_tz
+import hashlib
+import io
+import json
+import os
+import random
 import re
+import tempfile
+import threading
+import time
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 import requests
 
+# Addon-specific modules
+from precache import JsonCache, get_file_signature
+from preerrors import PrevodException, PrevodLoginException, PrevodNotFoundException, \
+    PrevodRejectedException, PrevodTimeoutException, PrevodUnavailableException
+
+
+# Time budget of single action, shared by all its requests
+class Deadline(object):
+
+    # Params:
+    #  seconds: Time budget from now
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return self.expires - time.time()
+
+
+# Stops sending requests to the site after several consecutive
+# connection errors or server errors; after cool-down period only
+# one probe request is let through, success closes the breaker.
+# State is kept in addon profile, so it is shared by invocations.
+class CircuitBreaker(object):
+    FAILURE_THRESHOLD = 3
+    # Seconds
+    COOL_DOWN = 5 * 60
+    PROBE_TIMEOUT = 60
+
+    # Params:
+    #  state_path: Path to JSON file, state is kept
+    #              only in memory if omitted
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.state = {'failures': 0, 'opened': 0, 'probe': 0}
+        self.signature = None
+        self._load()
+
+    # Loads state again if file was changed since, failures
+    # are counted together with other invocations and service
+    def _load(self):
+        if not self.state_path:
+            return
+        signature = get_file_signature(self.state_path)
+        if signature is None or signature == self.signature:
+            return
+        try:
+            with open(self.state_path, 'r') as f:
+                self.state.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            return
+        self.signature = signature
 
-# Custom exception, easy to catch
-# all errors occurring in this class
-class PrevodException(Exception):
-    pass
+    def _save(self):
+        if not self.state_path:
+            return
+        with open(self.state_path, 'w') as f:
+            json.dump(self.state, f)
+        self.signature = get_file_signature(self.state_path)
+
+    def is_open(self):
+        return self.state['failures'] >= self.FAILURE_THRESHOLD
+
+    # Return:
+    #  True if request may be sent
+    def allow(self):
+        with self.lock:
+            self._load()
+            if not self.is_open():
+                return True
+            now = time.time()
+            if now - self.state['opened'] < self.COOL_DOWN:
+                return False
+            # Another request is already probing the site
+            if now - self.state['probe'] < self.PROBE_TIMEOUT:
+                return False
+            self.state['probe'] = now
+            self._save()
+            return True
+
+    def success(self):
+        with self.lock:
+            self._load()
+            if self.state['failures'] or self.state['probe']:
+                self.state = {'failures': 0, 'opened': 0, 'probe': 0}
+                self._save()
+
+    def failure(self):
+        with self.lock:
+            self._load()
+            self.state['failures'] += 1
+            if self.is_open():
+                self.state['opened'] = time.time()
+                self.state['probe'] = 0
+            self._save()
 
 
 # Custom season parser due to complex
@@ -117,6 +220,8 @@ class Prevodi(object):
     REGEX_EPISODE = r'href="(\/preuzmi\-prijevod\/\S+)".+?>(.+?)<\/a>(.+?)opis">(.+?)<\/td>'
     REGEX_ATTACHMENT = r'attachment; filename="(.+)"'
     REGEX_LOGIN_ERROR = r'<p class="error">(.+)</p>'
+    # Login form, where site redirects when session is not valid
+    REGEX_LOGIN_PAGE = r'action=login\b'
     SEARCH_URL_KEY = 'search_url'
     SEARCH_KEY_KEY = 'search_key'
     SEARCH_FIELD_USER = 'user'
@@ -125,6 +230,46 @@ class Prevodi(object):
     HEADER_CONT_DESC = 'Content-Description'
     HEADER_TRANS_ENC = 'Content-Transfer-Encoding'
     HEADER_CONT_DISP = 'Content-Disposition'
+    # File in addon profile holding session cookies
+    SESSION_FILE = 'session.json'
+    # Lifetime of cookies without explicit expiry (PHP session), in seconds
+    SESSION_COOKIE_TTL = 24 * 60
+    # Cache of search URL and key found on home page
+    SEARCH_PARAMS_FILE = 'search_params.json'
+    SEARCH_PARAMS_TTL = 24 * 60 * 60
+    # Cache of search results, keyed by normalized search term
+    SEARCH_RESULTS_FILE = 'search_results.json'
+    SEARCH_RESULTS_TTL = 24 * 60 * 60
+    # Search results without wanted show are kept only as long
+    # as shows not found, so that new shows are found soon
+    SEARCH_MISS_TTL = 6 * 60 * 60
+    # Cache of parsed season maps, keyed by show ID; entries are
+    # revalidated with the site on every use, TTL only limits
+    # how long unused shows are kept
+    SEASONS_FILE = 'seasons.json'
+    SEASONS_TTL = 30 * 24 * 60 * 60
+    # State of circuit breaker
+    BREAKER_FILE = 'breaker.json'
+    # Timeouts of single request, in seconds
+    CONNECT_TIMEOUT = 3.05
+    READ_TIMEOUT = 10
+    # Attempts of failed request, and backoff between
+    # attempts (doubled after each one), in seconds
+    RETRY_ATTEMPTS = 3
+    RETRY_BACKOFF = 0.5
+    RETRY_MAX_BACKOFF = 8
+    # Longest wait server may ask for with Retry-After,
+    # request is given up if it asks for more
+    RETRY_AFTER_MAX = 30
+    # Archives are streamed to disk in chunks of this size,
+    # larger archives are refused
+    CHUNK_SIZE = 16 * 1024
+    MAX_ARCHIVE_SIZE = 5 * 1024 * 1024
+    # Archives of known size up to this one are kept in memory
+    IN_MEMORY_ARCHIVE_SIZE = 512 * 1024
+    # Concurrent requests to the site in batch operations,
+    # regardless of number of worker threads
+    MAX_HOST_CONNECTIONS = 2
     USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.79 Safari/537.36'
     HEADERS = {
         'Host': PREVODI_SITE_NAME,
@@ -136,28 +281,268 @@ class Prevodi(object):
         'User-agent': USER_AGENT,
     }
 
-    def __init__(self, username, password):
+    # Params:
+    #  username, password: Credentials for the site
+    #  profile_dir: Addon profile directory, session is not
+    #               persisted if omitted
+    def __init__(self, username, password, profile_dir=None):
         self.username = username
         self.password = password
         self.sess = requests.Session()
+        self.logged_in = False
+        self.session_file = None
+        params_file = results_file = seasons_file = breaker_file = None
+        if profile_dir:
+            self.session_file = os.path.join(profile_dir, self.SESSION_FILE)
+            params_file = os.path.join(profile_dir, self.SEARCH_PARAMS_FILE)
+            results_file = os.path.join(profile_dir, self.SEARCH_RESULTS_FILE)
+            seasons_file = os.path.join(profile_dir, self.SEASONS_FILE)
+            breaker_file = os.path.join(profile_dir, self.BREAKER_FILE)
+        self.params_cache = JsonCache(params_file, self.SEARCH_PARAMS_TTL)
+        self.search_cache = JsonCache(results_file, self.SEARCH_RESULTS_TTL)
+        self.search_miss_ttl = self.SEARCH_MISS_TTL
+        self.seasons_cache = JsonCache(seasons_file, self.SEASONS_TTL)
+        self.breaker = CircuitBreaker(breaker_file)
+        # Optional logger, set by caller
+        self.log = None
+        self.login_lock = threading.Lock()
+        # Number of logins so far, so that threads finding
+        # same session expired log in again only once
+        self.login_generation = 0
+        # Optional Deadline of current action, set by caller
+        self.deadline = None
+        self.retry_attempts = self.RETRY_ATTEMPTS
+        self.max_archive_size = self.MAX_ARCHIVE_SIZE
+        # Optional check of first bytes of archive, returning
+        # False for content that cannot be handled; set by caller
+        self.archive_check = None
+        self.archive_check_size = 0
+        self.host_slots = threading.BoundedSemaphore(self.MAX_HOST_CONNECTIONS)
         self.search_url = None
         self.search_key = None
+        self.search_term = None
         self.season = None
         self.episode = None
         self.tv_show = None
         self.shows = dict()
         self.seasons = dict()
         self.seasparser = SeasonParser()
-        self.subtparser = PrijevodParser()
         self.show_id = None
         self.archive = None
         self.archives = None
+        self._load_session()
+
+    # Restores cookies saved by previous invocation, if
+    # they have not expired and belong to the same user
+    def _load_session(self):
+        if not self.session_file or not os.path.exists(self.session_file):
+            return
+        try:
+            with open(self.session_file, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('username') != self.username:
+            return
+        now = time.time()
+        for cookie in data.get('cookies', []):
+            # Cookies without own expiry live as long as server session
+            expires = cookie['expires'] or data.get('session_expires', 0)
+            if expires <= now:
+                continue
+            self.sess.cookies.set(
+                cookie['name'],
+                cookie['value'],
+                domain=cookie['domain'],
+                path=cookie['path'],
+                secure=cookie['secure'],
+                expires=cookie['expires'])
+        self.logged_in = len(self.sess.cookies) > 0
+
+    # Saves session cookies to profile directory, each with its
+    # own expiry; cookies without one (PHP session) are valid
+    # for server's session lifetime from now on
+    def save_session(self):
+        if not self.session_file or not self.logged_in:
+            return
+        cookies = list()
+        for cookie in self.sess.cookies:
+            cookies.append({
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'secure': cookie.secure,
+                'expires': cookie.expires
+            })
+        data = {
+            'username': self.username,
+            'session_expires': time.time() + self.SESSION_COOKIE_TTL,
+            'cookies': cookies
+        }
+        with open(self.session_file, 'w') as f:
+            json.dump(data, f)
+
+    # Drops saved session, both in memory and on disk
+    def clear_session(self):
+        self.sess.cookies.clear()
+        self.logged_in = False
+        if self.session_file and os.path.exists(self.session_file):
+            os.remove(self.session_file)
+
+    def _debug(self, message):
+        if self.log:
+            self.log.debug(message)
+
+    # Search term used as cache key: case and
+    # surrounding or repeated whitespace ignored
+    @staticmethod
+    def _normalize_search_term(search_term):
+        return u' '.join(search_term.lower().split())
+
+    # Returns (connect, read) timeout for next request,
+    # shortened to what is left of action's time budget
+    def _get_timeout(self):
+        connect, read = self.CONNECT_TIMEOUT, self.READ_TIMEOUT
+        if self.deadline:
+            remaining = self.deadline.remaining()
+            if remaining <= 0:
+                raise PrevodTimeoutException("Time budget of action is used up")
+            connect, read = min(connect, remaining), min(read, remaining)
+        return connect, read
+
+    # Marks error as failure of site, counted by circuit breaker
+    # Params:
+    #  count_failure: Count it right away; otherwise caller
+    #                 counts it, once for all attempts of request
+    def _site_failure(self, error, count_failure):
+        error.site_failure = True
+        if count_failure:
+            self.breaker.failure()
+        return error
+
+    # Sends request with timeouts, unless circuit breaker is open;
+    # timeouts, connection errors and server errors are
+    # counted by circuit breaker and reported as PrevodException
+    # Params:
+    #  count_failure: Count failure with circuit breaker
+    def _send(self, method, url, count_failure=True, **kwargs):
+        kwargs['timeout'] = self._get_timeout()
+        if not self.breaker.allow():
+            raise PrevodUnavailableException("Site is considered unavailable, request not sent")
+        try:
+            r = self.sess.request(method, url, **kwargs)
+        except requests.Timeout as e:
+            raise self._site_failure(PrevodTimeoutException(
+                u"Request to '{0}' timed out: {1}".format(url, e)), count_failure)
+        except requests.ConnectionError as e:
+            raise self._site_failure(PrevodUnavailableException(
+                u"Request to '{0}' failed: {1}".format(url, e)), count_failure)
+        if r.status_code >= 500:
+            error = PrevodUnavailableException(u"Request to '{0}' failed with status {1}".format(
+                url, r.status_code))
+            error.retry_after = r.headers.get('Retry-After')
+            raise self._site_failure(error, count_failure)
+        self.breaker.success()
+        return r
+
+    # Return:
+    #  Seconds to wait before next attempt: exponential backoff
+    #  with jitter, but not shorter than server asked for;
+    #  None if server asked for longer than RETRY_AFTER_MAX
+    def _get_retry_delay(self, attempt, retry_after):
+        delay = min(self.RETRY_MAX_BACKOFF, self.RETRY_BACKOFF * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after:
+            if retry_after.strip().isdigit():
+                delay = max(delay, int(retry_after))
+            else:
+                retry_date = parsedate_tz(retry_after)
+                if retry_date:
+                    delay = max(delay, mktime_tz(retry_date) - time.time())
+        if delay > self.RETRY_AFTER_MAX:
+            return None
+        return delay
+
+    # Sends request, trying again after transient failures
+    # (timeout, connection error, server error, too many requests)
+    # as long as attempts and action's time budget allow it;
+    # failed request counts as single failure of site,
+    # however many attempts it took
+    def _send_with_retry(self, method, url, **kwargs):
+        attempt = 0
+        site_failure = False
+        while True:
+            attempt += 1
+            try:
+                r = self._send(method, url, count_failure=False, **kwargs)
+                if r.status_code != 429:
+                    return r
+                error = PrevodUnavailableException(u"Too many requests to '{0}'".format(url))
+                retry_after = r.headers.get('Retry-After')
+            except (PrevodTimeoutException, PrevodUnavailableException) as e:
+                error = e
+                retry_after = getattr(e, 'retry_after', None)
+                site_failure = site_failure or getattr(e, 'site_failure', False)
+            delay = self._get_retry_delay(attempt, retry_after)
+            if attempt >= self.retry_attempts or self.breaker.is_open() or delay is None or \
+                    (self.deadline and delay >= self.deadline.remaining()):
+                if site_failure:
+                    self.breaker.failure()
+                raise error
+            self._debug(u"Attempt {0} of '{1}' failed ({2}), retrying in {3:.1f} s".format(
+                attempt, url, error, delay))
+            time.sleep(delay)
+
+    # Checks if response is login page or SMF error
+    # instead of requested authenticated resource
+    def _is_logged_out(self, r):
+        regpage = re.compile(self.REGEX_LOGIN_PAGE)
+        for resp in r.history + [r]:
+            if regpage.search(resp.url) or regpage.search(resp.headers.get('Location', '')):
+                return True
+        if not r.headers.get('Content-Type', '').startswith('text/html'):
+            return False
+        return re.search(self.REGEX_LOGIN_ERROR, r.text) is not None
+
+    # Reports client errors as PrevodException, server
+    # errors are already reported by _send()
+    @staticmethod
+    def _check_status(r, url):
+        if r.status_code == 404:
+            raise PrevodNotFoundException(u"Resource '{0}' was not found".format(url))
+        if r.status_code >= 400:
+            raise PrevodRejectedException(u"Request to '{0}' was rejected with status {1}".format(
+                url, r.status_code))
+
+    # Performs HTTP request, logging in first if resource requires it
+    # Params:
+    #  method: HTTP method
+    #  url: Resource URL
+    #  authenticated: Resource requires login
+    # Return:
+    #  Response object
+    def _request(self, method, url, authenticated=False, **kwargs):
+        kwargs.setdefault('headers', self.HEADERS)
+        if authenticated:
+            self.login()
+        generation = self.login_generation
+        r = self._send_with_retry(method, url, **kwargs)
+        self._check_status(r, url)
+        if authenticated and self._is_logged_out(r):
+            # Session expired on server side, log in once more and retry
+            self.login(force=True, generation=generation)
+            r = self._send_with_retry(method, url, **kwargs)
+            self._check_status(r, url)
+            if self._is_logged_out(r):
+                raise PrevodLoginException("Site rejected session for '{0}'".format(url))
+        return r
 
     # Parses HTML page looking for search URL and key
     # Return:
     #   Dictionary with search URL and key
     def _get_site_search_params(self):
-        r = self.sess.get(self.PREVODI_HOME_URL)
+        r = self._request('GET', self.PREVODI_HOME_URL, headers=None)
         regurl = re.compile(self.REGEX_SEARCH_URL)
         regkey = re.compile(self.REGEX_SEARCH_KEY)
         match = regurl.search(r.text)
@@ -172,6 +557,34 @@ class Prevodi(object):
             raise PrevodException("Search key was not found!")
         self.search_url = url
         self.search_key = key
+        self.params_cache.set(self.SEARCH_URL_KEY, url)
+        self.params_cache.set(self.SEARCH_KEY_KEY, key)
+
+    # Takes search URL and key from memory or cache if possible,
+    # otherwise parses them from home page
+    # Return:
+    #   True if values were not parsed just now, so that site
+    #   may have changed them since; long running processes
+    #   keep values in memory beyond cache TTL
+    def _load_site_search_params(self):
+        if self.search_url and self.search_key:
+            return True
+        self.search_url = self.params_cache.get(self.SEARCH_URL_KEY)
+        self.search_key = self.params_cache.get(self.SEARCH_KEY_KEY)
+        if self.search_url and self.search_key:
+            return True
+        self._get_site_search_params()
+        return False
+
+    # Posts search term to site search
+    # Return:
+    #   Response text, empty if nothing was found
+    def _post_search(self, search_term):
+        r = self._request(
+            'POST',
+            "{0}/{1}".format(self.PREVODI_HOME_URL, self.search_url),
+            data={'search': search_term, 'key': self.search_key})
+        return r.text
 
     # Parses HTMl page for search results
     # Return:
@@ -200,31 +613,73 @@ class Prevodi(object):
         else:
             return None
 
-    def login(self):
-        r = self.sess.post(
-            url=self.PREVODI_LOGIN_URL,
+    # Logs in, unless valid session was restored from profile
+    # Params:
+    #  force: Log in even if session looks valid
+    #  generation: Login generation in which session was found
+    #              expired; forced login is skipped if another
+    #              thread has logged in again since then
+    def login(self, force=False, generation=None):
+        with self.login_lock:
+            if force and generation is not None and generation != self.login_generation and self.logged_in:
+                return
+            self._login(force)
+
+    def _login(self, force):
+        if self.logged_in and not force:
+            return
+        if force:
+            self.clear_session()
+        r = self._send(
+            'POST',
+            self.PREVODI_LOGIN_URL,
             data={
                 self.SEARCH_FIELD_USER: self.username,
                 self.SEARCH_FIELD_PASS: self.password,
                 self.SEARCH_FIELD_CLEN: '-1'},
             headers=self.HEADERS)
-        r.raise_for_status()
+        self._check_status(r, self.PREVODI_LOGIN_URL)
         # In spite of OK status, check if error occured
         regex = re.compile(self.REGEX_LOGIN_ERROR)
         match = regex.search(r.text)
         if match:
-            raise PrevodException(match.group(1))
+            raise PrevodLoginException(match.group(1))
+        self.logged_in = True
+        self.login_generation += 1
+        self.save_session()
 
     # Search by given keyword
-    def search(self, search_term):
-        if not self.search_url or not self.search_key:
+    # Params:
+    #  use_cache: Take results from search cache, if there
+    def search(self, search_term, use_cache=True):
+        self.search_term = search_term
+        cache_key = self._normalize_search_term(search_term)
+        shows = self.search_cache.get(cache_key) if use_cache else None
+        if shows is not None:
+            self._debug(u"Search cache hit for '{0}'".format(cache_key))
+            self.shows = shows
+            return
+        self._debug(u"Search cache {0} for '{1}'".format('miss' if use_cache else 'bypass', cache_key))
+        may_be_stale = self._load_site_search_params()
+        try:
+            html_page = self._post_search(search_term)
+        except (PrevodNotFoundException, PrevodRejectedException):
+            # Search rejected, e.g. with changed key; timeouts and
+            # unavailable site say nothing about search parameters
+            if not may_be_stale:
+                raise
+            html_page = ''
+        if may_be_stale and not html_page.strip():
+            # Site may have changed its search parameters, search
+            # once more with fresh ones; empty answer then means
+            # nothing was found
+            self._debug(u"Search for '{0}' rejected or empty, refreshing search parameters".format(cache_key))
+            self.params_cache.invalidate(self.SEARCH_URL_KEY)
+            self.params_cache.invalidate(self.SEARCH_KEY_KEY)
             self._get_site_search_params()
-        r = self.sess.post(
-            url="{0}/{1}".format(self.PREVODI_HOME_URL, self.search_url),
-            data={'search': search_term, 'key': self.search_key},
-            headers=self.HEADERS)
-        r.raise_for_status()
-        self.shows = self._get_result_links(r.text)
+            html_page = self._post_search(search_term)
+        self.shows = self._get_result_links(html_page)
+        self.search_cache.set(cache_key, self.shows, ttl=None if self.shows else self.search_miss_ttl)
 
     # We come here with exact title
     def get_tv_show(self, title):
@@ -233,49 +688,245 @@ class Prevodi(object):
         for key, value in shows_lower.items():
             shows_lower[key.lower()] = value
         if title_lower not in list(shows_lower.keys()):
-            raise PrevodException(u"Exact show title '{0}' could not be found".format(title))
+            if self.search_term is not None:
+                self.search_cache.limit_ttl(self._normalize_search_term(self.search_term), self.search_miss_ttl)
+            raise PrevodNotFoundException(u"Exact show title '{0}' could not be found".format(title))
         self.tv_show = title
         # Create ID for caching purposes
         self.show_id = '-'.join(shows_lower[title_lower].split('/')[-2:])
-        r = self.sess.get(
-            url="{0}{1}".format(self.PREVODI_HOME_URL, shows_lower[title_lower]),
-            headers=self.HEADERS)
-        r.raise_for_status()
-        # Get all valid subtitle links
-        self.seasparser.feed(r.text.replace("\n", "").replace("\r", ""))
-        self.seasons = self.seasparser.get_tv_show()
+        # Revalidate cached season map instead of downloading
+        # and parsing show page again
+        cached = self.seasons_cache.get(self.show_id, allow_stale=True)
+        headers = dict(self.HEADERS)
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+        r = self._request(
+            'GET',
+            "{0}{1}".format(self.PREVODI_HOME_URL, shows_lower[title_lower]),
+            headers=headers)
+        if cached and r.status_code == 304:
+            self._debug(u"Season map of '{0}' not modified".format(self.show_id))
+            self.seasons = cached['seasons']
+            self.seasons_cache.set(self.show_id, cached)
+            return
+        html_page = r.text.replace("\n", "").replace("\r", "")
+        page_hash = hashlib.sha1(html_page.encode('utf-8')).hexdigest()
+        if cached and cached['hash'] == page_hash:
+            self._debug(u"Season map of '{0}' unchanged".format(self.show_id))
+            self.seasons = cached['seasons']
+        else:
+            # Get all valid subtitle links
+            self.seasparser = SeasonParser()
+            self.seasparser.feed(html_page)
+            self.seasons = self.seasparser.get_tv_show()
+            self._debug(u"Parsed season map of '{0}'".format(self.show_id))
+        self.seasons_cache.set(self.show_id, {
+            'seasons': self.seasons,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'hash': page_hash
+        })
 
-    # Get links for subtitles for season and episode
-    def get_subtitles(self, season, episode):
-        # Format season and episode appropriately
+    # Gets subtitle archives of single episode, each
+    # response is parsed by its own parser
+    # Return:
+    #   Dictionary with archive link and (description, suitability)
+    def _get_episode_archives(self, season, episode):
         try:
             subtitle = self.seasons[season][episode][1]
         except KeyError:
-            raise PrevodException(u"Invalid parameters for TV show '{0}': season {1}, episode {2}".format(
+            raise PrevodNotFoundException(u"Invalid parameters for TV show '{0}': season {1}, episode {2}".format(
                 self.tv_show, season, episode))
-        r = self.sess.post(
-            url="{0}{1}/".format(self.PREVODI_HOME_URL, subtitle),
-            data={'key': self.search_key},
-            headers=self.HEADERS)
-        r.raise_for_status()
+        # Search may have been answered from cache,
+        # listing is still requested with site's key
+        self._load_site_search_params()
+        r = self._request(
+            'POST',
+            "{0}{1}/".format(self.PREVODI_HOME_URL, subtitle),
+            authenticated=True,
+            data={'key': self.search_key})
+        parser = PrijevodParser()
+        parser.feed(r.text)
+        return parser.get_archives()
+
+    # Get links for subtitles for season and episode
+    def get_subtitles(self, season, episode):
+        self.archives = self._get_episode_archives(season, episode)
         self.season = season
         self.episode = episode
-        self.subtparser.feed(r.text)
-        self.archives = self.subtparser.get_archives()
 
-    # Get subtitle archive itself
-    def get_subtitle_archive(self, archive_link):
+    # Get links for subtitles of several episodes concurrently,
+    # at most MAX_HOST_CONNECTIONS requests are made at once
+    # Params:
+    #  episodes: Season number for whole season, or
+    #            list of (season, episode) pairs
+    #  workers: Number of worker threads
+    # Return:
+    #  Dictionary (season, episode) -> archives; archives are empty
+    #  if episode is not in season map, None if request failed
+    def get_subtitles_batch(self, episodes, workers=4):
+        if not isinstance(episodes, list):
+            episodes = [(episodes, epis) for epis in sorted(self.seasons.get(episodes, {}).keys())]
+        if not episodes:
+            return dict()
+        # Search key and login are taken care of
+        # before workers start, so they do not race for them
+        self._load_site_search_params()
+        self.login()
+        queue = Queue()
+        for item in episodes:
+            queue.put(item)
+        results = dict()
+        results_lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    season, episode = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    with self.host_slots:
+                        archives = self._get_episode_archives(season, episode)
+                except PrevodNotFoundException as e:
+                    self._debug(e)
+                    archives = dict()
+                except (PrevodException, requests.RequestException) as e:
+                    self._debug(u"Episode {0}x{1} failed: {2}".format(season, episode, e))
+                    archives = None
+                with results_lock:
+                    results[(season, episode)] = archives
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(episodes))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    # Get subtitle archive itself; small archives are read into
+    # memory, others are streamed to file in given directory.
+    # Headers are checked before body is read and download is
+    # aborted once it is too large.
+    # Return:
+    #   Archive name, and either file object with archive
+    #   content or path to archive file
+    def get_subtitle_archive(self, archive_link, dest_dir):
         if not archive_link:
             raise PrevodException("Link for downloading archive was not provided!")
-        r = self.sess.get(
-            url="{0}{1}".format(self.PREVODI_HOME_URL, archive_link),
+        r = self._request(
+            'GET',
+            "{0}{1}".format(self.PREVODI_HOME_URL, archive_link),
+            authenticated=True,
             allow_redirects=True,
-            headers=self.HEADERS)
-        r.raise_for_status()
-        # Check if this is indeed archive
-        archive_name = self._get_archive_name(r.headers)
-        if archive_name:
-            self.archive = archive_name
-            return archive_name, r.content,
-        else:
-            raise PrevodException("Archive '{0}' is not a subtitle archive!".format(archive_link))
+            stream=True)
+        try:
+            # Check if this is indeed archive
+            archive_name = self._get_archive_name(r.headers)
+            if not archive_name:
+                raise PrevodException("Archive '{0}' is not a subtitle archive!".format(archive_link))
+            length = r.headers.get('Content-Length', '')
+            length = int(length) if length.isdigit() and 'Content-Encoding' not in r.headers else None
+            if length is not None and length > self.max_archive_size:
+                raise PrevodException("Archive '{0}' is too large: {1} bytes".format(archive_link, length))
+            if length is not None and length <= self.IN_MEMORY_ARCHIVE_SIZE:
+                archive = io.BytesIO()
+                self._stream_body(r, archive, length)
+                archive.seek(0)
+            else:
+                archive = os.path.join(dest_dir, archive_name)
+                self._stream_to_file(r, archive, length)
+        finally:
+            r.close()
+        self.archive = archive_name
+        return archive_name, archive,
+
+    # Copies response body to file object, checking size
+    # limit and action's time budget after each chunk
+    def _stream_body(self, r, f, length):
+        size = 0
+        head = b''
+        try:
+            for chunk in r.iter_content(self.CHUNK_SIZE):
+                # Unsupported content is refused before rest of it is read
+                if self.archive_check and len(head) < self.archive_check_size:
+                    head += chunk
+                    if len(head) >= self.archive_check_size and not self.archive_check(head):
+                        raise PrevodException("Archive '{0}' has unsupported format".format(r.url))
+                size += len(chunk)
+                if size > self.max_archive_size:
+                    raise PrevodException("Archive '{0}' exceeds {1} bytes".format(
+                        r.url, self.max_archive_size))
+                if self.deadline and self.deadline.remaining() <= 0:
+                    raise PrevodTimeoutException("Time budget of action is used up")
+                f.write(chunk)
+        except requests.RequestException as e:
+            raise PrevodUnavailableException(u"Download of '{0}' failed: {1}".format(r.url, e))
+        if self.archive_check and len(head) < self.archive_check_size and not self.archive_check(head):
+            raise PrevodException("Archive '{0}' has unsupported format".format(r.url))
+        if length is not None and size != length:
+            raise PrevodException("Archive '{0}' is incomplete: {1} of {2} bytes".format(
+                r.url, size, length))
+
+    # Writes response body to temporary file, which
+    # replaces destination only when body is complete
+    def _stream_to_file(self, r, dest_path, length):
+        fd, temp_path = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(dest_path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self._stream_body(r, f, length)
+            if os.name == 'nt' and os.path.exists(dest_path):
+                os.remove(dest_path)
+            os.rename(temp_path, dest_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+
+# Same interface as Prevodi, but login is started in background
+# as soon as it is clear site will be contacted, so that it
+# overlaps with home page, search and show page requests
+# instead of waiting for first authenticated request
+class PipelinedPrevodi(Prevodi):
+
+    def __init__(self, username, password, profile_dir=None):
+        Prevodi.__init__(self, username, password, profile_dir)
+        self.login_thread = None
+        self.login_error = None
+
+    def _start_login(self):
+        if self.logged_in or self.login_thread or not self.username:
+            return
+
+        def run():
+            try:
+                Prevodi.login(self)
+            except Exception as e:
+                self.login_error = e
+
+        self.login_error = None
+        self.login_thread = threading.Thread(target=run)
+        self.login_thread.daemon = True
+        self.login_thread.start()
+
+    # Waits for background login, if any, and
+    # raises its error in caller's thread
+    def login(self, force=False, generation=None):
+        if self.login_thread:
+            self.login_thread.join()
+            self.login_thread = None
+            if self.login_error:
+                error, self.login_error = self.login_error, None
+                raise error
+        Prevodi.login(self, force, generation)
+
+    def search(self, search_term, use_cache=True):
+        if not use_cache or self.search_cache.get(self._normalize_search_term(search_term)) is None:
+            self._start_login()
+        Prevodi.search(self, search_term, use_cache)
+
+    def get_tv_show(self, title):
+        self._start_login()
+        Prevodi.get_tv_show(self, title)
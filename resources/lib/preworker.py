@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# Local socket between plugin invocations and resident worker
+# in service, which keeps site session, caches and UnRAR executable
+# warm between invocations. Each connection carries one request
+# and one response, both single JSON lines:
+#  {"method": ..., "params": {...}}
+#  {"result": ...} or {"error": <exception name>, "message": ...}
+
+import json
+import os
+import socket
+import stat
+import threading
+
+# Addon-specific module
+from preerrors import PrevodArchiveException, PrevodException, PrevodLoginException, \
+    PrevodNotFoundException, PrevodRejectedException, PrevodTimeoutException, PrevodUnavailableException
+
+# Socket inside addon profile directory
+SOCKET_FILE = 'worker.sock'
+# Seconds worker waits for request after connection
+REQUEST_TIMEOUT = 5
+
+
+# Raised when worker cannot be reached or cannot do the
+# job, plugin then does the job itself
+class WorkerException(Exception):
+    pass
+
+
+# Errors raised in worker are raised again in plugin
+ERRORS = dict((error.__name__, error,) for error in (
+    PrevodArchiveException,
+    PrevodException,
+    PrevodLoginException,
+    PrevodNotFoundException,
+    PrevodRejectedException,
+    PrevodTimeoutException,
+    PrevodUnavailableException,
+    WorkerException))
+
+
+# Return:
+#   True if platform has Unix sockets
+def is_supported():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def get_socket_path(profile_dir):
+    return os.path.join(profile_dir, SOCKET_FILE)
+
+
+def _send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def _receive_message(sock):
+    f = sock.makefile('rb')
+    try:
+        line = f.readline()
+    finally:
+        f.close()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+class WorkerClient(object):
+
+    # Params:
+    #  socket_path: Path to worker's socket
+    #  timeout: Seconds to wait for worker's answer
+    def __init__(self, socket_path, timeout):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    # Sends request to worker and waits for its answer
+    # Return:
+    #   Result of request
+    def call(self, method, **params):
+        if not is_supported() or not os.path.exists(self.socket_path):
+            raise WorkerException("Worker is not running")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            _send_message(sock, {'method': method, 'params': params})
+            response = _receive_message(sock)
+        except (socket.error, IOError, OSError, ValueError) as e:
+            raise WorkerException("Worker did not answer: {0}".format(e))
+        finally:
+            sock.close()
+        if response is None:
+            raise WorkerException("Worker closed connection")
+        if 'error' in response:
+            raise ERRORS.get(response['error'], WorkerException)(response['message'])
+        return response['result']
+
+
+class WorkerServer(object):
+
+    # Params:
+    #  socket_path: Path to socket, created on start
+    #  handler: Callable taking method name and params,
+    #           returning result that can be put in JSON
+    def __init__(self, socket_path, handler):
+        self.socket_path = socket_path
+        self.handler = handler
+        self.log = None
+        self.sock = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def _error(self, message):
+        if self.log:
+            self.log.error(message)
+
+    def start(self):
+        # Left by previous run that was not stopped
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        os.chmod(self.socket_path, stat.S_IRUSR | stat.S_IWUSR)
+        self.sock.listen(4)
+        # Accept does not block for good, so that stop is noticed
+        self.sock.settimeout(1)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    # Requests are handled one by one, plugin
+    # invocations do not overlap anyway
+    def _serve(self):
+        while not self.stopped.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                self._error("Worker socket failed: {0}".format(e))
+                return
+            try:
+                conn.settimeout(REQUEST_TIMEOUT)
+                self._handle(conn)
+            except (socket.error, IOError, OSError, ValueError, KeyError) as e:
+                self._error("Worker request failed: {0}".format(e))
+            finally:
+                conn.close()
+
+    def _handle(self, conn):
+        request = _receive_message(conn)
+        if request is None:
+            return
+        # Answer may take as long as request's time budget
+        conn.settimeout(None)
+        try:
+            response = {'result': self.handler(request['method'], request.get('params', dict()))}
+        except PrevodException as e:
+            response = {'error': type(e).__name__, 'message': u"{0}".format(e)}
+        except Exception as e:
+            # Plugin does the job itself
+            self._error("Worker could not handle '{0}': {1}".format(request.get('method'), e))
+            response = {'error': WorkerException.__name__, 'message': u"{0}".format(e)}
+        _send_message(conn, response)
@@ -243,6 +243,10 @@ ALT_CHECK_ARGS = ('--help',)
 # ALT_TEST_ARGS = ('-test',) # does not work
 # ALT_CHECK_ARGS = ('-v',)
 
+#: whether UNRAR_TOOL was checked; set to True after configuring
+#: UNRAR_TOOL by hand to skip the check on first use
+TOOL_CHECKED = False
+
 #: whether to speed up decompression by using tmp archive
 USE_EXTRACT_HACK = 1
 
@@ -882,6 +886,7 @@ class RarFile(object):
     def testrar(self):
         """Let 'unrar' test the archive.
         """
+        _ensure_unrar_tool()
         cmd = [UNRAR_TOOL] + list(TEST_ARGS)
         add_password_arg(cmd, self._password)
         cmd.append('--')
@@ -920,6 +925,7 @@ class RarFile(object):
 
     # call unrar to extract a file
     def _extract(self, fnlist, path=None, psw=None):
+        _ensure_unrar_tool()
         cmd = [UNRAR_TOOL] + list(EXTRACT_ARGS)
 
         # pasoword
@@ -1246,6 +1252,7 @@ class CommonParser(object):
 
     # extract using unrar
     def _open_unrar(self, rarfile, inf, psw=None, tmpfile=None, force_file=False):
+        _ensure_unrar_tool()
         cmd = [UNRAR_TOOL] + list(OPEN_ARGS)
         add_password_arg(cmd, psw)
         cmd.append("--")
@@ -2891,6 +2898,7 @@ def rar3_decompress(vers, meth, data, declen=0, flags=0, crc=0, psw=None, salt=N
         tmpf.write(RAR_ID + mh + hdr + data)
         tmpf.close()
 
+        _ensure_unrar_tool()
         cmd = [UNRAR_TOOL] + list(OPEN_ARGS)
         add_password_arg(cmd, psw, (flags & RAR_FILE_PASSWORD))
         cmd.append(tmpname)
@@ -3088,13 +3096,13 @@ ORIG_EXTRACT_ARGS = EXTRACT_ARGS
 ORIG_TEST_ARGS = TEST_ARGS
 
 
-def _check_unrar_tool():
+def _check_unrar_tool(tool=ORIG_UNRAR_TOOL):
     global UNRAR_TOOL, OPEN_ARGS, EXTRACT_ARGS, TEST_ARGS
     try:
         # does UNRAR_TOOL work?
-        custom_check([ORIG_UNRAR_TOOL], True)
+        custom_check([tool], True)
 
-        UNRAR_TOOL = ORIG_UNRAR_TOOL
+        UNRAR_TOOL = tool
         OPEN_ARGS = ORIG_OPEN_ARGS
         EXTRACT_ARGS = ORIG_EXTRACT_ARGS
         TEST_ARGS = ORIG_TEST_ARGS
@@ -3113,4 +3121,10 @@ def _check_unrar_tool():
     return True
 
 
-_check_unrar_tool()
+# Check is not done at import time, since it runs external
+# program; it is done before the tool is first needed
+def _ensure_unrar_tool():
+    global TOOL_CHECKED
+    if not TOOL_CHECKED:
+        TOOL_CHECKED = True
+        _check_unrar_tool(UNRAR_TOOL)
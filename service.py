@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+# Optional service prefetching subtitles for upcoming
+# episodes of the show being played, so that opening
+# subtitle dialog for them is only a local lookup
+#
+# Service also runs optional resident worker, doing site
+# requests for plugin invocations with warm session
+
+# System modules
+import json
+import os
+import sys
+import threading
+
+# Kodi modules
+import xbmc
+import xbmcaddon
+import xbmcgui
+
+__addon__ = xbmcaddon.Addon()
+get_local_str = __addon__.getLocalizedString
+
+if sys.version_info[0] >= 3:
+    __cwd__ = xbmc.translatePath(__addon__.getAddonInfo('path'))
+    __profile__ = xbmc.translatePath(__addon__.getAddonInfo('profile'))
+    __resource__ = xbmc.translatePath(os.path.join(__cwd__, 'resources', 'lib'))
+    __resdata__ = xbmc.translatePath(os.path.join(__cwd__, 'resources', 'data'))
+    __cache__ = xbmc.translatePath(os.path.join(__profile__, 'cache'))
+    __unrar__ = xbmc.translatePath(os.path.join(__profile__, 'unrar'))
+    __temp__ = xbmc.translatePath(os.path.join(__profile__, 'temp'))
+else:
+    __cwd__ = xbmc.translatePath(__addon__.getAddonInfo('path')).decode("utf-8")
+    __profile__ = xbmc.translatePath(__addon__.getAddonInfo('profile')).decode("utf-8")
+    __resource__ = xbmc.translatePath(os.path.join(__cwd__, 'resources', 'lib')).decode("utf-8")
+    __resdata__ = xbmc.translatePath(os.path.join(__cwd__, 'resources', 'data')).decode("utf-8")
+    __cache__ = xbmc.translatePath(os.path.join(__profile__, 'cache')).decode("utf-8")
+    __unrar__ = xbmc.translatePath(os.path.join(__profile__, 'unrar')).decode("utf-8")
+    __temp__ = xbmc.translatePath(os.path.join(__profile__, 'temp')).decode("utf-8")
+
+sys.path.insert(0, __resource__)
+
+# Addon modules
+from prefetcher import Fetcher
+from prelogging import Prelogger
+from preindex import CacheEviction, CacheIndex
+from prevodi import Deadline, PrevodException, PipelinedPrevodi
+import preutils as pu
+import preworker
+
+
+# Notifies service about started playback
+class PrefetchPlayer(xbmc.Player):
+
+    def __init__(self, service):
+        xbmc.Player.__init__(self)
+        self.service = service
+
+    def onAVStarted(self):
+        self.service.playback_started = True
+
+
+class PrefetchService(object):
+    SETTINGS_USERNAME = 'prevodi-username'
+    SETTINGS_PASSWORD = 'prevodi-password'
+    SETTINGS_NEGATIVE_TTL = 'negative-cache-ttl'
+    SETTINGS_SEARCH_TTL = 'search-cache-ttl'
+    SETTINGS_RETRY_ATTEMPTS = 'retry-attempts'
+    SETTINGS_MAX_ARCHIVE_SIZE = 'max-archive-size'
+    SETTINGS_WORKER = 'worker'
+    SETTINGS_CACHE_SIZE = 'cache-size'
+    SETTINGS_CACHE_ENTRIES = 'cache-entries'
+    SETTINGS_LISTING_TTL = 'listing-ttl'
+    SETTINGS_SEASONS_TTL = 'seasons-ttl'
+    SETTINGS_SUBTITLE_TTL = 'subtitle-ttl'
+    SETTINGS_PREFETCH = 'prefetch'
+    SETTINGS_PREFETCH_COUNT = 'prefetch-count'
+    SETTINGS_PREFETCH_DOWNLOAD = 'prefetch-download'
+    # Seconds spent on cache eviction at once, service has
+    # more time for it than plugin
+    EVICTION_BUDGET = 1
+    # Fetcher methods plugin may call in worker
+    WORKER_METHODS = ('fetch_listing', 'fetch_subtitle',)
+
+    def __init__(self):
+        self.log = Prelogger()
+        self.monitor = xbmc.Monitor()
+        self.player = PrefetchPlayer(self)
+        self.playback_started = False
+        self.worker = None
+        # Fetcher kept by worker between requests, with
+        # credentials it was created with
+        self.worker_fetcher = None
+        self.worker_credentials = None
+        self.worker_lock = threading.Lock()
+        self.eviction = None
+
+    @staticmethod
+    def get_int_setting(setting_id, default):
+        try:
+            return int(__addon__.getSetting(setting_id))
+        except ValueError:
+            return default
+
+    @staticmethod
+    def json_rpc(method, params):
+        request = {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': 1}
+        response = json.loads(xbmc.executeJSONRPC(json.dumps(request)))
+        return response.get('result', {})
+
+    def run(self):
+        while not self.monitor.abortRequested():
+            self.update_worker()
+            self.evict_cache()
+            if self.playback_started:
+                self.playback_started = False
+                if __addon__.getSetting(self.SETTINGS_PREFETCH) == 'true':
+                    try:
+                        self.prefetch()
+                    except Exception as e:
+                        # Prefetch is best effort, never stop the service
+                        self.log.error("Prefetch failed: {0}".format(e))
+            if self.monitor.waitForAbort(1):
+                break
+        if self.worker:
+            self.worker.stop()
+
+    # Removes least recently used items that are too old or
+    # do not fit into cache limits when eviction is due,
+    # so that plugin rarely has to do it
+    def evict_cache(self):
+        if not os.path.exists(__cache__):
+            return
+        if self.eviction is None:
+            self.eviction = CacheEviction(
+                CacheIndex(os.path.join(__profile__, CacheIndex.INDEX_FILE)),
+                __cache__,
+                os.path.join(__profile__, CacheEviction.MARKER_FILE))
+        if not self.eviction.is_due():
+            return
+        # Settings might have changed since previous run
+        self.eviction.listing_ttl = self.get_int_setting(self.SETTINGS_LISTING_TTL, 3) * 24 * 60 * 60
+        self.eviction.subtitle_ttl = self.get_int_setting(self.SETTINGS_SUBTITLE_TTL, 14) * 24 * 60 * 60
+        self.eviction.max_entries = self.get_int_setting(self.SETTINGS_CACHE_ENTRIES, 1000)
+        self.eviction.max_size = self.get_int_setting(self.SETTINGS_CACHE_SIZE, 50) * 1024 * 1024
+        items = self.eviction.run(self.EVICTION_BUDGET)
+        self.log.debug("Removed items from cache: {0}".format(items))
+
+    # Starts or stops worker, following its setting
+    def update_worker(self):
+        enabled = __addon__.getSetting(self.SETTINGS_WORKER) == 'true' and preworker.is_supported()
+        if enabled and not self.worker:
+            worker = preworker.WorkerServer(preworker.get_socket_path(__profile__), self.handle_request)
+            worker.log = self.log
+            try:
+                worker.start()
+            except (IOError, OSError) as e:
+                # E.g. socket path too long, plugin works without worker
+                self.log.error("Worker could not start: {0}".format(e))
+                __addon__.setSetting(self.SETTINGS_WORKER, 'false')
+                return
+            self.worker = worker
+            self.log.debug("Worker started")
+        elif not enabled and self.worker:
+            self.worker.stop()
+            self.worker = None
+            self.worker_fetcher = None
+            self.log.debug("Worker stopped")
+
+    # Handles request of plugin invocation
+    # Params:
+    #  method: Name of Fetcher method
+    #  params: Its keyword arguments, with time budget of action
+    def handle_request(self, method, params):
+        if method not in self.WORKER_METHODS:
+            raise ValueError("Unknown worker method '{0}'".format(method))
+        with self.worker_lock:
+            fetcher = self.get_worker_fetcher()
+            fetcher.prev.deadline = Deadline(params.pop('budget'))
+            try:
+                return getattr(fetcher, method)(**params)
+            finally:
+                # Plugin without worker uses saved session
+                fetcher.prev.save_session()
+
+    # Returns fetcher kept between requests, session is
+    # started again only when credentials have changed
+    def get_worker_fetcher(self):
+        credentials = (__addon__.getSetting(self.SETTINGS_USERNAME), __addon__.getSetting(self.SETTINGS_PASSWORD),)
+        if self.worker_fetcher is None or credentials != self.worker_credentials:
+            self.worker_fetcher = self.get_fetcher()
+            self.worker_credentials = credentials
+        prev = self.worker_fetcher.prev
+        prev.search_cache.ttl = self.get_int_setting(self.SETTINGS_SEARCH_TTL, 24) * 60 * 60
+        prev.retry_attempts = max(1, self.get_int_setting(self.SETTINGS_RETRY_ATTEMPTS, 3))
+        prev.max_archive_size = self.get_int_setting(self.SETTINGS_MAX_ARCHIVE_SIZE, 5120) * 1024
+        self.worker_fetcher.misses.ttl = self.get_int_setting(self.SETTINGS_NEGATIVE_TTL, 6) * 60 * 60
+        return self.worker_fetcher
+
+    # Creates fetcher with fresh settings, they
+    # might have changed since previous playback
+    def get_fetcher(self):
+        for direct in __cache__, __unrar__, __temp__:
+            if not os.path.exists(direct):
+                os.makedirs(direct)
+        prev = PipelinedPrevodi(
+            __addon__.getSetting(self.SETTINGS_USERNAME),
+            __addon__.getSetting(self.SETTINGS_PASSWORD),
+            __profile__)
+        prev.log = self.log
+        prev.seasons_cache.ttl = self.get_int_setting(self.SETTINGS_SEASONS_TTL, 30) * 24 * 60 * 60
+        fetcher = Fetcher(prev, __profile__, self.get_int_setting(self.SETTINGS_NEGATIVE_TTL, 6) * 60 * 60)
+        fetcher.log = self.log
+        fetcher.res_data = __resdata__
+        fetcher.unrar_dir = __unrar__
+        fetcher.temp_dir = __temp__
+        fetcher.dialog = xbmcgui.DialogProgressBG()
+        fetcher.str_get_unrar = get_local_str(32023)
+        return fetcher
+
+    # Returns currently played episode, None if
+    # something else is played
+    def get_playing_episode(self):
+        result = self.json_rpc('Player.GetItem', {
+            'playerid': 1,
+            'properties': ['tvshowid', 'showtitle', 'season', 'episode']})
+        item = result.get('item', {})
+        if item.get('type') != 'episode' or not item.get('showtitle'):
+            return None
+        return item
+
+    # Returns map of (season, episode) to video file path
+    # for show in video library
+    def get_library_files(self, tvshowid):
+        if tvshowid is None or tvshowid < 0:
+            return dict()
+        result = self.json_rpc('VideoLibrary.GetEpisodes', {
+            'tvshowid': tvshowid,
+            'properties': ['season', 'episode', 'file']})
+        files = dict()
+        for episode in result.get('episodes', []):
+            key = (str(episode['season']).zfill(2), str(episode['episode']).zfill(2))
+            files[key] = episode['file']
+        return files
+
+    # Returns languages chosen for subtitle download in Kodi
+    def get_preferred_languages(self):
+        result = self.json_rpc('Settings.GetSettingValue', {'setting': 'subtitles.languages'})
+        return ','.join(result.get('value', []))
+
+    # Returns next N episodes after given one, following
+    # order of season map parsed from show page
+    @staticmethod
+    def get_next_episodes(seasons, season, episode, count):
+        episodes = list()
+        for seas in sorted(seasons.keys()):
+            for epis in sorted(seasons[seas].keys()):
+                if (seas, epis) > (season, episode):
+                    episodes.append((seas, epis,))
+                    if len(episodes) == count:
+                        return episodes
+        return episodes
+
+    def prefetch(self):
+        item = self.get_playing_episode()
+        if not item:
+            return
+        tvshow_title = item['showtitle']
+        season = str(item['season']).zfill(2)
+        episode = str(item['episode']).zfill(2)
+        count = self.get_int_setting(self.SETTINGS_PREFETCH_COUNT, 2)
+        fetcher = self.get_fetcher()
+        try:
+            fetcher.load_tv_show(tvshow_title)
+        except PrevodException as e:
+            self.log.error(e)
+            return
+        next_episodes = self.get_next_episodes(fetcher.prev.seasons, season, episode, count)
+        self.log.debug(u"Prefetching subtitles for '{0}': {1}".format(tvshow_title, next_episodes))
+        download = __addon__.getSetting(self.SETTINGS_PREFETCH_DOWNLOAD) == 'true'
+        if download:
+            files = self.get_library_files(item.get('tvshowid'))
+            langs_map = pu.get_language_list(self.get_preferred_languages())
+        show_cachedir = os.path.join(__cache__, pu.get_cache_dir_title(tvshow_title))
+        listings = dict()
+        for seas, epis in next_episodes:
+            archives = fetcher.index.load_listing(os.path.join(show_cachedir, "{0}x{1}".format(seas, epis)))
+            if archives is not None:
+                listings[(seas, epis)] = archives
+        missing = [key for key in next_episodes if key not in listings]
+        listings.update(fetcher.fetch_listings(tvshow_title, missing, show_cachedir, len(missing)))
+        fetcher.prev.save_session()
+        if not download:
+            return
+        for (seas, epis), archives in sorted(listings.items()):
+            if self.monitor.abortRequested():
+                return
+            if (seas, epis) not in files:
+                continue
+            cachedir = os.path.join(show_cachedir, "{0}x{1}".format(seas, epis))
+            fetcher.fetch_preferred_subtitles(archives, cachedir, files[(seas, epis)], langs_map)
+        fetcher.prev.save_session()
+
+
+# end class PrefetchService
+
+PrefetchService().run()
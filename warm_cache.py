@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Fills subtitle cache for many episodes at once, outside of
+# Kodi, e.g. overnight for whole TV library
+#
+# Input has one episode per line, fields separated by tab:
+#   <show title> <season> <episode> <video file path>
+#
+# Episodes already in cache are skipped, so interrupted
+# run can simply be started again
+#
+# Example:
+#   python warm_cache.py -p ~/.kodi/userdata/addon_data/service.subtitles.prijevodi-online-org \
+#       -u username -w password -i episodes.txt -j 4 -d -l English,Serbian
+
+# System modules
+import argparse
+import io
+import os
+import sys
+import threading
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+__cwd__ = os.path.dirname(os.path.abspath(__file__))
+__resource__ = os.path.join(__cwd__, 'resources', 'lib')
+__resdata__ = os.path.join(__cwd__, 'resources', 'data')
+
+sys.path.insert(0, __resource__)
+
+# Kodi modules are replaced before addon modules are imported
+import preheadless
+preheadless.install()
+
+# Addon modules
+from prefetcher import Fetcher
+from prelogging import Prelogger
+from prevodi import PrevodException, Prevodi
+import preutils as pu
+
+
+class CacheWarmer(object):
+    # Outcomes counted in summary
+    STATUS_CACHED = 'cached'
+    STATUS_FETCHED = 'fetched'
+    STATUS_MISSING = 'missing'
+    STATUS_FAILED = 'failed'
+
+    def __init__(self, args):
+        self.args = args
+        self.log = Prelogger()
+        self.profile = os.path.abspath(os.path.expanduser(args.profile))
+        self.cache = os.path.join(self.profile, 'cache')
+        self.unrar = os.path.join(self.profile, 'unrar')
+        self.temp = os.path.join(self.profile, 'temp')
+        for direct in self.cache, self.unrar, self.temp:
+            if not os.path.exists(direct):
+                os.makedirs(direct)
+        self.langs_map = pu.get_language_list(args.languages)
+        self.lock = threading.Lock()
+        self.summary = dict.fromkeys(
+            (self.STATUS_CACHED, self.STATUS_FETCHED, self.STATUS_MISSING, self.STATUS_FAILED), 0)
+        self.downloaded = 0
+        self.done = 0
+        self.total = 0
+        # Caches are shared, each worker has its own session
+        self.prev = Prevodi(args.username, args.password, self.profile)
+        self.prev.log = self.log
+
+    # Reads episodes, grouped by show so that
+    # each show is searched only once
+    def read_episodes(self):
+        if self.args.input == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with io.open(self.args.input, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        shows = dict()
+        for line in lines:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) != 4:
+                self.log.error(u"Skipping malformed line: {0}".format(line.strip()))
+                continue
+            title, season, episode, filepath = fields
+            shows.setdefault(title, []).append((season.zfill(2), episode.zfill(2), filepath,))
+            self.total += 1
+        return shows
+
+    def get_fetcher(self):
+        prev = Prevodi(self.args.username, self.args.password, self.profile)
+        prev.log = self.log
+        prev.params_cache = self.prev.params_cache
+        prev.search_cache = self.prev.search_cache
+        prev.seasons_cache = self.prev.seasons_cache
+        fetcher = Fetcher(prev, self.profile, self.args.misses_ttl * 60 * 60)
+        fetcher.misses = self.fetcher.misses
+        fetcher.log = self.log
+        fetcher.res_data = __resdata__
+        fetcher.unrar_dir = self.unrar
+        fetcher.temp_dir = self.temp
+        fetcher.dialog = preheadless.ConsoleProgress()
+        fetcher.str_get_unrar = "Fetching UnRAR executable ..."
+        return fetcher
+
+    def report(self, title, season, episode, status):
+        with self.lock:
+            self.summary[status] += 1
+            self.done += 1
+            sys.stderr.write(u"[{0}/{1}] {2} {3}x{4}: {5}\n".format(
+                self.done, self.total, title, season, episode, status))
+
+    # Fetches listings of all show's episodes not yet
+    # in cache with one batch, then downloads subtitles
+    def warm_show(self, fetcher, title, episodes):
+        show_cachedir = os.path.join(self.cache, pu.get_cache_dir_title(title))
+        listings = dict()
+        statuses = dict()
+        for season, episode, filepath in episodes:
+            archives = fetcher.index.load_listing(os.path.join(show_cachedir, "{0}x{1}".format(season, episode)))
+            if archives is not None:
+                listings[(season, episode)] = archives
+                statuses[(season, episode)] = self.STATUS_CACHED
+        missing = [(season, episode) for season, episode, filepath in episodes
+                   if (season, episode) not in listings]
+        if missing:
+            fetched = fetcher.fetch_listings(title, missing, show_cachedir, self.args.episode_jobs)
+            listings.update(fetched)
+            for key in missing:
+                statuses[key] = self.STATUS_FETCHED if key in fetched else self.STATUS_MISSING
+        for season, episode, filepath in episodes:
+            status = statuses[(season, episode)]
+            archives = listings.get((season, episode))
+            if archives and self.args.download:
+                try:
+                    cachedir = os.path.join(show_cachedir, "{0}x{1}".format(season, episode))
+                    subtitles = fetcher.fetch_preferred_subtitles(archives, cachedir, filepath, self.langs_map)
+                    with self.lock:
+                        self.downloaded += len(subtitles)
+                except Exception as e:
+                    self.log.error(u"{0} {1}x{2}: {3}".format(title, season, episode, e))
+                    status = self.STATUS_FAILED
+            self.report(title, season, episode, status)
+
+    def worker(self, queue):
+        fetcher = self.get_fetcher()
+        while True:
+            try:
+                title, episodes = queue.get_nowait()
+            except Empty:
+                break
+            try:
+                self.warm_show(fetcher, title, episodes)
+            except Exception as e:
+                self.log.error(u"{0}: {1}".format(title, e))
+                for season, episode, filepath in episodes:
+                    self.report(title, season, episode, self.STATUS_FAILED)
+
+    def run(self):
+        shows = self.read_episodes()
+        self.fetcher = Fetcher(self.prev, self.profile, self.args.misses_ttl * 60 * 60)
+        # Log in once, workers reuse saved session
+        try:
+            self.prev.login()
+        except PrevodException as e:
+            self.log.error(e)
+            return 1
+        queue = Queue()
+        for title, episodes in shows.items():
+            queue.put((title, episodes,))
+        workers = [threading.Thread(target=self.worker, args=(queue,))
+                   for _ in range(max(1, min(self.args.jobs, len(shows))))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.prev.save_session()
+        sys.stderr.write("Episodes: {0}, {1}, subtitles downloaded: {2}\n".format(
+            self.total,
+            ', '.join("{0}: {1}".format(key, value) for key, value in sorted(self.summary.items())),
+            self.downloaded))
+        return 1 if self.summary[self.STATUS_FAILED] else 0
+
+
+# end class CacheWarmer
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fill prijevodi-online.org subtitle cache")
+    parser.add_argument('-p', '--profile', required=True, help="addon profile directory")
+    parser.add_argument('-u', '--username', required=True, help="prijevodi-online.org username")
+    parser.add_argument('-w', '--password', required=True, help="prijevodi-online.org password")
+    parser.add_argument('-i', '--input', default='-', help="episode list, '-' for standard input")
+    parser.add_argument('-j', '--jobs', type=int, default=2, help="shows processed concurrently")
+    parser.add_argument('-e', '--episode-jobs', type=int, default=4, help="episode lists fetched concurrently per show")
+    parser.add_argument('-d', '--download', action='store_true', help="download and extract subtitles too")
+    parser.add_argument('-l', '--languages', default='English', help="comma separated languages to download")
+    parser.add_argument('-m', '--misses-ttl', type=int, default=6, help="hours to remember episodes not found")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print debug messages")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    preheadless.VERBOSE = arguments.verbose
+    sys.exit(CacheWarmer(arguments).run())